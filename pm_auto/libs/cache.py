@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+
+class LRUCache():
+    '''
+    Bounded least recently used cache with hit and miss counters.
+
+    max_size: maximum total size of all entries
+    sizeof: function returning the size of a value, defaults to 1 per entry,
+            so max_size is then the maximum entry count
+    '''
+    def __init__(self, max_size=128, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _sizeof(self, value):
+        if self.sizeof is None:
+            return 1
+        return self.sizeof(value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.size -= self._sizeof(self._data.pop(key))
+            if size > self.max_size:
+                # Would evict everything and still not fit, don't cache it
+                return
+            self._data[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= self._sizeof(evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data.pop(key)
+            self.size -= self._sizeof(value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._data),
+            'size': self.size,
+            'max_size': self.max_size,
+        }
@@ -0,0 +1,287 @@
+# Fan controller
+#
+# Turn a CPU temperature into a fan level and duty. Modes:
+#
+# - step: move one level per update when the temperature leaves the
+#         current level's low/high band, the original behaviour
+# - jump: go straight to the level the temperature belongs to, using the
+#         same low/high bands as hysteresis
+# - curve: interpolate a user temperature -> duty curve, precompiled into a
+#          lookup table, with hysteresis degrees on the way down
+# - pid: drive the duty to hold a target temperature
+#
+# In every mode the fan speeds up immediately, but only slows down after
+# min_dwell seconds at the current output.
+#
+# TemperatureFilter smooths the raw samples fed to the controller and
+# estimates how fast the temperature is moving.
+#
+import time
+from array import array
+
+CONTROL_STEP = 'step'
+CONTROL_JUMP = 'jump'
+CONTROL_CURVE = 'curve'
+CONTROL_PID = 'pid'
+CONTROL_MODES = [CONTROL_STEP, CONTROL_JUMP, CONTROL_CURVE, CONTROL_PID]
+
+# [temperature, duty percent] points, sorted by temperature
+DEFAULT_CURVE = [[50, 0], [55, 40], [65, 80], [75, 100]]
+# Curves of other sensors, by sensor kind or name, see sysfs.Sensor
+DEFAULT_SENSOR_CURVES = {
+    'nvme': [[50, 0], [55, 40], [65, 80], [70, 100]],
+    'rp1_adc': [[60, 0], [65, 40], [75, 80], [80, 100]],
+}
+DEFAULT_PID = {
+    'target': 60,
+    'kp': 8.0,
+    'ki': 0.2,
+    'kd': 4.0,
+}
+
+# Lookup table range and resolution in Celsius
+LUT_MIN = -20
+LUT_MAX = 120
+LUT_STEP = 0.5
+
+def compile_curve(curve):
+    '''
+    Precompile curve points into a lookup table of duties, one per LUT_STEP
+    from LUT_MIN to LUT_MAX. Below the first point the duty is the first
+    point's, above the last point the last point's.
+    '''
+    points = sorted((float(t), float(d)) for t, d in curve)
+    if len(points) == 0:
+        raise ValueError("Fan curve needs at least one point")
+    for _, duty in points:
+        if duty < 0 or duty > 100:
+            raise ValueError(f"Invalid fan curve duty: {duty}")
+    lut = array('B')
+    count = int((LUT_MAX - LUT_MIN) / LUT_STEP) + 1
+    i = 0
+    for n in range(count):
+        temperature = LUT_MIN + n * LUT_STEP
+        while i < len(points) and points[i][0] <= temperature:
+            i += 1
+        if i == 0:
+            duty = points[0][1]
+        elif i == len(points):
+            duty = points[-1][1]
+        else:
+            t0, d0 = points[i - 1]
+            t1, d1 = points[i]
+            duty = d0 + (d1 - d0) * (temperature - t0) / (t1 - t0)
+        lut.append(int(round(duty)))
+    return lut
+
+class TemperatureFilter():
+    '''
+    Ring buffer of the latest samples with EMA smoothing and a least squares
+    slope estimate. The least squares sums are kept up to date as samples
+    come and go, so both are O(1) per sample. Only falling temperatures are
+    smoothed, a rise is followed at once so the fan never speeds up late.
+
+    size: samples kept for the slope
+    alpha: EMA weight of a new, lower sample, 1 disables smoothing
+    '''
+    def __init__(self, size=10, alpha=0.3):
+        if size < 2:
+            raise ValueError("Temperature filter needs at least 2 samples")
+        if alpha <= 0 or alpha > 1:
+            raise ValueError(f"Invalid temperature filter alpha: {alpha}")
+        self.size = size
+        self.alpha = alpha
+        # Times are stored relative to base, which follows the samples so
+        # the least squares sums stay small and precise
+        self.times = array('d', bytes(8 * size))
+        self.values = array('d', bytes(8 * size))
+        self.base = None
+        self.index = 0
+        self.count = 0
+        self.value = None
+        self.sum_t = 0.0
+        self.sum_v = 0.0
+        self.sum_tt = 0.0
+        self.sum_tv = 0.0
+
+    def add(self, timestamp, temperature):
+        '''Add a sample, return the filtered temperature'''
+        if self.base is None:
+            self.base = timestamp
+        index = self.index
+        if self.count == self.size:
+            # Drop the oldest sample from the sums
+            t = self.times[index]
+            v = self.values[index]
+            self.sum_t -= t
+            self.sum_v -= v
+            self.sum_tt -= t * t
+            self.sum_tv -= t * v
+        else:
+            self.count += 1
+        t = timestamp - self.base
+        self.times[index] = t
+        self.values[index] = temperature
+        self.sum_t += t
+        self.sum_v += temperature
+        self.sum_tt += t * t
+        self.sum_tv += t * temperature
+        index += 1
+        if index == self.size:
+            index = 0
+            self._rebase()
+        self.index = index
+        if self.value is None or temperature >= self.value:
+            self.value = temperature
+        else:
+            self.value += self.alpha * (temperature - self.value)
+        return self.value
+
+    def _rebase(self):
+        '''Move base to the newest sample and recompute the sums exactly'''
+        shift = self.times[-1]
+        self.base += shift
+        self.sum_t = self.sum_v = self.sum_tt = self.sum_tv = 0.0
+        for i in range(self.count):
+            t = self.times[i] - shift
+            v = self.values[i]
+            self.times[i] = t
+            self.sum_t += t
+            self.sum_v += v
+            self.sum_tt += t * t
+            self.sum_tv += t * v
+
+    def slope(self):
+        '''Temperature change in Celsius per second, 0 until 2 samples'''
+        n = self.count
+        if n < 2:
+            return 0.0
+        denominator = n * self.sum_tt - self.sum_t * self.sum_t
+        if denominator == 0:
+            return 0.0
+        return (n * self.sum_tv - self.sum_t * self.sum_v) / denominator
+
+    def predict(self, seconds):
+        '''Filtered temperature projected seconds ahead'''
+        if self.value is None:
+            return None
+        return self.value + self.slope() * seconds
+
+class FanController():
+    '''
+    levels: fan levels with name, low, high and percent, like FAN_LEVELS
+    mode: one of CONTROL_MODES
+    curve: [temperature, duty] points for curve mode
+    hysteresis: degrees the temperature must drop below a curve point
+                before the duty follows it down, curve mode only
+    min_dwell: seconds the output is held before it may go down
+    pid: target, kp, ki, kd for pid mode
+    '''
+    def __init__(self, levels, mode=CONTROL_STEP, curve=DEFAULT_CURVE,
+            hysteresis=2, min_dwell=0, pid=DEFAULT_PID, clock=time.monotonic):
+        if mode not in CONTROL_MODES:
+            raise ValueError(f"Invalid fan control mode: {mode}")
+        self.levels = levels
+        self.mode = mode
+        self.hysteresis = hysteresis
+        self.min_dwell = min_dwell
+        self.pid = dict(DEFAULT_PID)
+        self.pid.update(pid)
+        self.clock = clock
+        self.lut = compile_curve(curve)
+        # Duty percent to level, the lowest level at least that fast
+        self.level_lut = array('B')
+        for duty in range(101):
+            level = len(levels) - 1
+            for i, l in enumerate(levels):
+                if l['percent'] >= duty:
+                    level = i
+                    break
+            self.level_lut.append(level)
+
+        self.level = 0
+        self.duty = levels[0]['percent']
+        self.changed_time = None
+        self._integral = 0.0
+        self._last_temperature = None
+        self._last_time = None
+
+    def lookup(self, temperature):
+        '''Duty of the curve at temperature'''
+        index = int((temperature - LUT_MIN) / LUT_STEP)
+        index = max(0, min(index, len(self.lut) - 1))
+        return self.lut[index]
+
+    def level_of(self, duty):
+        return self.level_lut[max(0, min(int(duty), 100))]
+
+    def _step(self, temperature):
+        level = self.level
+        if temperature < self.levels[level]['low']:
+            level -= 1
+        elif temperature > self.levels[level]['high']:
+            level += 1
+        level = max(0, min(level, len(self.levels) - 1))
+        return self.levels[level]['percent']
+
+    def _jump(self, temperature):
+        level = self.level
+        while level < len(self.levels) - 1 and temperature > self.levels[level]['high']:
+            level += 1
+        while level > 0 and temperature < self.levels[level]['low']:
+            level -= 1
+        return self.levels[level]['percent']
+
+    def _curve(self, temperature):
+        duty = self.lookup(temperature)
+        if duty >= self.duty:
+            return duty
+        # Going down, follow the curve shifted by the hysteresis
+        return min(self.duty, self.lookup(temperature + self.hysteresis))
+
+    def _pid(self, temperature, now):
+        error = temperature - self.pid['target']
+        derivative = 0.0
+        if self._last_time is not None:
+            dt = now - self._last_time
+            if dt > 0:
+                derivative = (temperature - self._last_temperature) / dt
+                self._integral += error * dt
+        self._last_temperature = temperature
+        self._last_time = now
+        # Anti windup, the integral term alone stays within 0 ~ 100
+        if self.pid['ki'] > 0:
+            self._integral = max(0.0, min(self._integral, 100 / self.pid['ki']))
+        duty = self.pid['kp'] * error + self.pid['ki'] * self._integral + self.pid['kd'] * derivative
+        return int(round(max(0, min(duty, 100))))
+
+    def boost(self):
+        '''
+        Go to full speed now, for example when the CPU is throttled. Held
+        at least min_dwell seconds after the last boost.
+        '''
+        self.level = len(self.levels) - 1
+        self.duty = self.levels[-1]['percent']
+        self.changed_time = self.clock()
+        return self.level, self.duty
+
+    def update(self, temperature):
+        '''Feed a temperature, return the (level, duty) to apply'''
+        now = self.clock()
+        if self.mode == CONTROL_STEP:
+            duty = self._step(temperature)
+        elif self.mode == CONTROL_JUMP:
+            duty = self._jump(temperature)
+        elif self.mode == CONTROL_CURVE:
+            duty = self._curve(temperature)
+        else:
+            duty = self._pid(temperature, now)
+
+        if duty < self.duty and self.changed_time is not None \
+                and now - self.changed_time < self.min_dwell:
+            duty = self.duty
+        if duty != self.duty:
+            self.duty = duty
+            self.changed_time = now
+        self.level = self.level_of(self.duty)
+        return self.level, self.duty
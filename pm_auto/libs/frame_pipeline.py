@@ -0,0 +1,145 @@
+# Frame pipeline
+#
+# Split OLED updates into a render stage and a transfer stage. The render
+# stage (the caller of SSD1306.display()) packs the frame into a back buffer
+# and hands it over without waiting for the I2C bus. A transfer thread always
+# sends the latest completed frame, frames replaced before being sent are
+# dropped, and frames identical to the last one sent are skipped.
+#
+import threading
+import time
+import zlib
+
+STATS_LOG_INTERVAL = 60
+
+class FramePipeline():
+    def __init__(self, oled, log=None):
+        if log is None:
+            import logging
+            log = logging.getLogger(__name__)
+        self.log = log
+        self.oled = oled
+        self.panel = oled.oled
+        size = len(self.panel._buffer)
+        # Back buffer written by the render stage, front buffer holds the
+        # latest completed frame waiting for the transfer stage.
+        self._back = bytearray(size)
+        self._front = bytearray(size)
+        self._front_hash = None
+        self._has_frame = False
+        self._last_hash = None
+        self._frame_start = None
+        self._condition = threading.Condition()
+
+        self.running = False
+        self.thread = None
+
+        self.frames_rendered = 0
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.frames_dropped = 0
+        self.render_time = 0.0
+        self.transfer_time = 0.0
+        self.last_render_time = 0.0
+        self.last_transfer_time = 0.0
+        self._stats_log_time = time.time()
+
+    def begin_frame(self):
+        '''Mark the start of rendering a frame, for render time statistics'''
+        self._frame_start = time.perf_counter()
+
+    def submit(self, image):
+        '''Pack a rendered image and hand it to the transfer stage'''
+        start = self._frame_start
+        if start is None:
+            start = time.perf_counter()
+        self.panel.pack(image, self._back)
+        frame_hash = zlib.crc32(self._back)
+        render_time = time.perf_counter() - start
+        self._frame_start = None
+        with self._condition:
+            if self._has_frame:
+                self.frames_dropped += 1
+            self._back, self._front = self._front, self._back
+            self._front_hash = frame_hash
+            self._has_frame = True
+            self.frames_rendered += 1
+            self.render_time += render_time
+            self.last_render_time = render_time
+            self._condition.notify()
+
+    def invalidate(self):
+        '''Send the next frame even if identical to the last one sent'''
+        with self._condition:
+            self._last_hash = None
+
+    def _transfer(self):
+        '''Send the front frame if any, must be called with the condition held'''
+        if not self._has_frame:
+            return
+        self._has_frame = False
+        if self._front_hash == self._last_hash:
+            self.frames_skipped += 1
+            return
+        self.panel._buffer[:] = self._front
+        self._last_hash = self._front_hash
+        start = time.perf_counter()
+        self._condition.release()
+        try:
+            self.panel.display()
+        except Exception:
+            self._last_hash = None
+            raise
+        finally:
+            self._condition.acquire()
+        transfer_time = time.perf_counter() - start
+        self.frames_sent += 1
+        self.transfer_time += transfer_time
+        self.last_transfer_time = transfer_time
+
+    def loop(self):
+        while self.running:
+            with self._condition:
+                while self.running and not self._has_frame:
+                    self._condition.wait()
+                if not self.running:
+                    break
+                try:
+                    self._transfer()
+                except Exception as e:
+                    self.log.error(f"Frame transfer failed: {e}")
+            if time.time() - self._stats_log_time > STATS_LOG_INTERVAL:
+                self._stats_log_time = time.time()
+                self.log.debug(f"OLED frame stats: {self.get_stats()}")
+
+    def get_stats(self):
+        rendered = max(self.frames_rendered, 1)
+        sent = max(self.frames_sent, 1)
+        return {
+            'frames_rendered': self.frames_rendered,
+            'frames_sent': self.frames_sent,
+            'frames_skipped': self.frames_skipped,
+            'frames_dropped': self.frames_dropped,
+            'render_time_avg_ms': round(self.render_time / rendered * 1000, 3),
+            'render_time_last_ms': round(self.last_render_time * 1000, 3),
+            'transfer_time_avg_ms': round(self.transfer_time / sent * 1000, 3),
+            'transfer_time_last_ms': round(self.last_transfer_time * 1000, 3),
+        }
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''Stop the transfer thread, then send the last frame if still pending'''
+        with self._condition:
+            self.running = False
+            self._condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self._condition:
+            self._transfer()
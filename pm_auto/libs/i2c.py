@@ -1,40 +1,220 @@
-from smbus2 import SMBus
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from smbus2 import SMBus, i2c_msg
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets in microseconds, one more
+# bucket counts everything slower
+LATENCY_BUCKETS_US = (50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+_LATENCY_BUCKETS = tuple(us / 1000000 for us in LATENCY_BUCKETS_US)
+STATS_LOG_INTERVAL = 60
+
+class FairLock():
+    '''
+    Reentrant lock handing itself to waiting threads in the order they
+    asked for it, so a thread polling in a tight loop can't starve others.
+    '''
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._next_ticket = 0
+        self._serving = 0
+        self._owner = None
+        self._count = 0
+
+    def acquire(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._owner == me:
+                self._count += 1
+                return True
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while ticket != self._serving:
+                self._condition.wait()
+            self._owner = me
+            self._count = 1
+        return True
+
+    def release(self):
+        with self._condition:
+            if self._owner != threading.get_ident():
+                raise RuntimeError("Cannot release un-acquired lock")
+            self._count -= 1
+            if self._count == 0:
+                self._owner = None
+                self._serving += 1
+                self._condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+class I2CStats():
+    '''
+    Counters of one operation on one address. The histogram is a fixed
+    array, recording costs a few increments.
+    '''
+    __slots__ = ('count', 'bytes', 'time', 'errors', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.time = 0.0
+        # errno: count
+        self.errors = {}
+        self.histogram = array('L', bytes(array('L').itemsize * (len(LATENCY_BUCKETS_US) + 1)))
+
+    def record(self, duration, nbytes, errno=None):
+        self.count += 1
+        self.time += duration
+        self.histogram[bisect_left(_LATENCY_BUCKETS, duration)] += 1
+        if errno is None:
+            self.bytes += nbytes
+        else:
+            self.errors[errno] = self.errors.get(errno, 0) + 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'bytes': self.bytes,
+            'time_ms': round(self.time * 1000, 3),
+            'errors': dict(self.errors),
+            'histogram': list(self.histogram),
+        }
+
+class I2CBus():
+    '''One SMBus handle per bus, shared by all devices on it, see get_bus()'''
+    def __init__(self, bus):
+        self.bus = bus
+        self.smbus = SMBus(bus)
+        self.lock = FairLock()
+        # (address, operation): I2CStats
+        self.stats = {}
+        self._stats_log_time = time.monotonic()
+
+    def transaction(self):
+        '''Hold the bus for several operations, use as a context manager'''
+        return self.lock
+
+    def call(self, address, operation, nbytes, func, *args):
+        '''Run func(*args) holding the bus, recording its statistics under address and operation'''
+        errno = None
+        with self.lock:
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            except OSError as e:
+                errno = e.errno
+                raise
+            finally:
+                duration = time.perf_counter() - start
+                stats = self.stats.get((address, operation))
+                if stats is None:
+                    stats = self.stats[(address, operation)] = I2CStats()
+                stats.record(duration, nbytes, errno)
+                if time.monotonic() - self._stats_log_time > STATS_LOG_INTERVAL:
+                    self._stats_log_time = time.monotonic()
+                    log.debug(f"I2C bus {self.bus} stats: {self.get_stats()}")
+
+    def get_stats(self):
+        '''Statistics by address, like '0x3C', then by operation'''
+        stats = {}
+        for (address, operation), entry in list(self.stats.items()):
+            stats.setdefault(f'0x{address:02X}', {})[operation] = entry.to_dict()
+        return stats
+
+_buses = {}
+_buses_lock = threading.Lock()
+
+# Probe results, {bus: {address: found}}, see I2C.probe()
+_probe_cache = {}
+# Buses fully scanned since the cache was last invalidated
+_scanned = set()
+_probe_lock = threading.Lock()
+
+SCAN_ADDRESSES = range(0x03, 0x77 + 1)
+
+def get_bus(bus=1):
+    '''The process wide I2CBus of a bus number'''
+    with _buses_lock:
+        if bus not in _buses:
+            _buses[bus] = I2CBus(bus)
+        return _buses[bus]
+
+def get_stats():
+    '''
+    I2C statistics of every bus opened, by bus, address and operation: count,
+    bytes, time_ms, errors by errno and a latency histogram with buckets
+    bounded by LATENCY_BUCKETS_US.
+    '''
+    with _buses_lock:
+        buses = list(_buses.values())
+    return {bus.bus: bus.get_stats() for bus in buses}
 
 class I2C():
+    '''
+    A device on an I2C bus. Devices share their bus' handle, every
+    operation holds the bus lock, use transaction() to group several.
+    '''
 
-    def __init__(self, address, bus=1):     
+    def __init__(self, address, bus=1):
         self._bus = bus
         self._address = address
-        self._smbus = SMBus(self._bus)
         if not I2C.enabled(self._bus):
             raise ValueError("I2C bus {} not enabled".format(self._bus))
+        self._i2c_bus = get_bus(self._bus)
+        self._smbus = self._i2c_bus.smbus
+        self._lock = self._i2c_bus.lock
+        self._call = self._i2c_bus.call
         if not self.is_ready():
             raise ValueError("I2C device not found at address 0x{:02X}".format(self._address))
 
+    def transaction(self):
+        '''Keep the bus for several operations, like a whole frame'''
+        return self._lock
+
     def write_byte(self, data):
-        return self._smbus.write_byte(self._address, data)
+        return self._call(self._address, 'write_byte', 1,
+            self._smbus.write_byte, self._address, data)
 
     def write_byte_data(self, reg, data):
-        return self._smbus.write_byte_data(self._address, reg, data)
+        return self._call(self._address, 'write_byte_data', 2,
+            self._smbus.write_byte_data, self._address, reg, data)
 
     def write_word_data(self, reg, data):
-        return self._smbus.write_word_data(self._address, reg, data)
+        return self._call(self._address, 'write_word_data', 3,
+            self._smbus.write_word_data, self._address, reg, data)
 
     def write_i2c_block_data(self, reg, data):
-        return self._smbus.write_i2c_block_data(self._address, reg, data)
+        return self._call(self._address, 'write_i2c_block_data', 1 + len(data),
+            self._smbus.write_i2c_block_data, self._address, reg, data)
+
+    def write_messages(self, *buffers):
+        """Write each buffer as one raw I2C message, all in a single I2C_RDWR
+        transaction.
+        """
+        msgs = [i2c_msg.write(self._address, buf) for buf in buffers]
+        nbytes = sum(len(buf) for buf in buffers)
+        return self._call(self._address, 'write_messages', nbytes,
+            self._smbus.i2c_rdwr, *msgs)
 
     def read_byte(self):
-        return self._smbus.read_byte(self._address)
+        return self._call(self._address, 'read_byte', 1,
+            self._smbus.read_byte, self._address)
 
     def read_i2c_block_data(self, reg, num):
-        return self._smbus.read_i2c_block_data(self._address, reg, num)
+        return self._call(self._address, 'read_i2c_block_data', 1 + num,
+            self._smbus.read_i2c_block_data, self._address, reg, num)
 
     def is_ready(self):
-        addresses = self.scan(self._bus)
-        if self._address in addresses:
-            return True
-        else:
-            return False
+        return self._address in self.probe([self._address], self._bus)
 
     @staticmethod
     def enabled(bus=1):
@@ -42,20 +222,57 @@ class I2C():
         return os.path.exists("/dev/i2c-{}".format(bus))
 
     @staticmethod
-    def scan(busnum=1, force=False):
-        devices = []
-        for addr in range(0x03, 0x77 + 1):
-            read = SMBus.read_byte, (addr,), {'force':force}
-            write = SMBus.write_byte, (addr, 0), {'force':force}
-            for func, args, kwargs in (read, write):
-                try:
-                    with SMBus(busnum) as bus:
-                        data = func(bus, *args, **kwargs)
-                        devices.append(addr)
-                        break
-                except OSError as expt:
-                    if expt.errno == 16:
-                        # just busy, maybe permanent by a kernel driver or just temporary by some user code
-                        pass
+    def _probe_address(bus, addr, force=False):
+        '''Check one address over an open bus, must hold the bus lock'''
+        read = bus.smbus.read_byte, (addr,), {'force':force}
+        write = bus.smbus.write_byte, (addr, 0), {'force':force}
+        for func, args, kwargs in (read, write):
+            try:
+                func(*args, **kwargs)
+                return True
+            except OSError as expt:
+                if expt.errno == 16:
+                    # just busy, maybe permanent by a kernel driver or just temporary by some user code
+                    pass
+        return False
+
+    @staticmethod
+    def probe(addresses, busnum=1, force=False, cached=True):
+        '''
+        Return which of addresses answer, checking only those over the shared
+        bus handle. Results are cached per process until
+        invalidate_scan_cache(), cached=False probes again.
+        '''
+        if not I2C.enabled(busnum):
+            return []
+        with _probe_lock:
+            cache = _probe_cache.setdefault(busnum, {})
+            missing = [addr for addr in addresses if not cached or addr not in cache]
+            if len(missing) > 0:
+                bus = get_bus(busnum)
+                with bus.transaction():
+                    for addr in missing:
+                        cache[addr] = I2C._probe_address(bus, addr, force)
+            return [addr for addr in addresses if cache[addr]]
+
+    @staticmethod
+    def scan(busnum=1, force=False, cached=True):
+        '''Probe every address, only the first time unless cached is False'''
+        if cached and busnum in _scanned:
+            return sorted(addr for addr, found in _probe_cache[busnum].items() if found)
+        devices = I2C.probe(SCAN_ADDRESSES, busnum, force, cached=False)
+        if I2C.enabled(busnum):
+            with _probe_lock:
+                _scanned.add(busnum)
         return devices
 
+    @staticmethod
+    def invalidate_scan_cache(busnum=None):
+        '''Forget probe and scan results of a bus, or of all buses'''
+        with _probe_lock:
+            if busnum is None:
+                _probe_cache.clear()
+                _scanned.clear()
+            else:
+                _probe_cache.pop(busnum, None)
+                _scanned.discard(busnum)
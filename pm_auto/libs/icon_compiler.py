@@ -0,0 +1,97 @@
+# Icon compiler
+#
+# Render the icons used by the oled pages into a packed 1 bit atlas, so the
+# OLED service can draw them straight from a memory mapped file instead of
+# decoding PNGs with Pillow at runtime. See IconAtlas in ssd1306.py.
+#
+# Run it after changing any icon or the way an oled page draws it:
+#
+#     python3 -m pm_auto.libs.icon_compiler
+#
+import os
+import zlib
+
+from .ssd1306 import render_icon, icon_atlas_key, \
+    ICON_ATLAS_FILE, ICON_ATLAS_MAGIC, ICON_ATLAS_VERSION, \
+    ICON_ATLAS_HEADER, ICON_ATLAS_ENTRY, \
+    ICON_ATLAS_FLAG_INVERT, ICON_ATLAS_FLAG_DITHER
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Icon variants drawn by the oled_page modules
+# (file name, scale, invert, dither, threshold)
+ICON_VARIANTS = [
+    # performance
+    ('cpu_icon_24.png', 1.0, False, True, 127),
+    ('ram_icon_24.png', 1.0, False, False, 127),
+    ('temperature_icon_24.png', 1.0, False, True, 127),
+    ('fan_icon_24.png', 1.0, False, False, 127),
+    # ips
+    ('ethernet_icon_20.png', 1.0, False, False, 80),
+    ('wifi_icon_20.png', 1.0, False, False, 85),
+    ('net_icon_20.png', 1.0, False, False, 100),
+    # disk
+    ('sdcard_icon_20.png', 1.0, False, False, 130),
+    ('nvme_icon_20.png', 1.0, False, False, 130),
+    ('usb_stick_icon_20.png', 1.0, False, False, 100),
+    # battery, power
+    ('battery_icon_40.png', 1.0, False, False, 127),
+    ('charge_icon_20.png', 1.0, False, False, 127),
+    ('charge_icon_20.png', 1.0, False, True, 127),
+    # input
+    ('cable_plug_icon_48.png', 1.0, False, False, 127),
+    ('cable_unplug_icon_48.png', 1.0, False, False, 127),
+    # output
+    ('raspberry_icon_48.png', 1.0, False, False, 127),
+    ('sunfounder.ico', 0.8, False, False, 130),
+]
+
+def compile_atlas(icons_dir, output, variants=ICON_VARIANTS):
+    '''
+    Render every variant of icons in icons_dir and write them to output.
+    Return the number of icons written.
+    '''
+    entries = []
+    keys = set()
+    for name, scale, invert, dither, threshold in variants:
+        key = icon_atlas_key(name, scale, invert, dither, threshold)
+        if key in keys:
+            continue
+        keys.add(key)
+        path = os.path.join(icons_dir, name)
+        with open(path, 'rb') as f:
+            crc = zlib.crc32(f.read())
+        img = render_icon(path, scale, invert, dither, threshold)
+        entries.append((key, img, crc))
+
+    offset = ICON_ATLAS_HEADER.size + ICON_ATLAS_ENTRY.size * len(entries)
+    index = bytearray(ICON_ATLAS_HEADER.pack(ICON_ATLAS_MAGIC, ICON_ATLAS_VERSION, len(entries)))
+    data = bytearray()
+    for (name, scale, invert, dither, threshold), img, crc in entries:
+        flags = 0
+        if invert:
+            flags |= ICON_ATLAS_FLAG_INVERT
+        if dither:
+            flags |= ICON_ATLAS_FLAG_DITHER
+        index += ICON_ATLAS_ENTRY.pack(name.encode(), scale, flags, threshold,
+            img.width, img.height, offset + len(data), crc)
+        data += img.tobytes()
+
+    with open(output, 'wb') as f:
+        f.write(index)
+        f.write(data)
+    return len(entries)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Compile OLED icons into a 1 bit atlas')
+    parser.add_argument('--icons', default=os.path.join(PACKAGE_DIR, 'icons'),
+        help='Icons directory')
+    parser.add_argument('--output', default=os.path.join(PACKAGE_DIR, ICON_ATLAS_FILE),
+        help='Atlas file to write')
+    args = parser.parse_args()
+    count = compile_atlas(args.icons, args.output)
+    print(f'{count} icons written to {args.output}')
+
+if __name__ == '__main__':
+    main()
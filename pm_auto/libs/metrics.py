@@ -0,0 +1,161 @@
+# Metrics sampler
+#
+# One place collecting system metrics for every service and oled page. Each
+# metric is collected at most once per its TTL, no matter how many threads
+# ask for it, and consumers get immutable snapshots so every view shows the
+# same sample.
+#
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+from .sysfs import SystemCollectors, ROOT
+
+# Seconds a collected value stays valid
+DEFAULT_TTL = {
+    'cpu_temperature': 1,
+    'cpu_percent': 1,
+    'memory': 1,
+    'disks': 5,
+    'ips': 3,
+    'fan_speed': 1,
+}
+
+METRICS = list(DEFAULT_TTL.keys())
+
+Snapshot = namedtuple('Snapshot', ['timestamp'] + METRICS)
+Snapshot.__doc__ = '''
+Immutable set of metrics. timestamp is the time of the oldest metric in
+it, metrics not requested hold their last collected value or None.
+'''
+
+def _collect_disks():
+    from sf_rpi_status import get_disks_info
+    return MappingProxyType(dict(get_disks_info()))
+
+def _collect_ips():
+    from sf_rpi_status import get_ips
+    return MappingProxyType(dict(get_ips()))
+
+class MetricsSampler():
+    '''
+    ttl: seconds each metric stays valid, overrides DEFAULT_TTL
+    collectors: functions collecting a metric, overrides the defaults
+    root: root of the sysfs/procfs tree read by the native collectors
+    '''
+    def __init__(self, ttl={}, collectors={}, root=ROOT, log=None, clock=time.monotonic):
+        if log is None:
+            import logging
+            log = logging.getLogger(__name__)
+        self.log = log
+        self.clock = clock
+        self.ttl = dict(DEFAULT_TTL)
+        self.ttl.update(ttl)
+        # CPU, memory and fan are read natively from /proc and sysfs
+        system = SystemCollectors(root=root)
+        self.collectors = {
+            'cpu_temperature': system.cpu_temperature,
+            'cpu_percent': system.cpu_percent,
+            'memory': system.memory,
+            'disks': _collect_disks,
+            'ips': _collect_ips,
+            'fan_speed': system.fan_speed,
+        }
+        self.collectors.update(collectors)
+        # name: (collect time, value)
+        self._values = {}
+        # Held only to publish values and counters
+        self._lock = threading.Lock()
+        # Held while collecting a metric, so a slow one like disks doesn't
+        # hold up the others, and concurrent callers collect it only once
+        self._collect_locks = {name: threading.Lock() for name in METRICS}
+        self.collections = 0
+        self.hits = 0
+
+    @staticmethod
+    def _check_name(name):
+        if name not in METRICS:
+            raise ValueError(f"Unknown metric: {name}")
+
+    def set_ttl(self, name, ttl):
+        self._check_name(name)
+        self.ttl[name] = ttl
+
+    def set_collector(self, name, collector):
+        self._check_name(name)
+        with self._collect_locks[name], self._lock:
+            self.collectors[name] = collector
+            self._values.pop(name, None)
+
+    def update_config(self, config):
+        if 'metrics_ttl' in config:
+            for name, ttl in config['metrics_ttl'].items():
+                self.log.debug(f"Update {name} ttl to {ttl}")
+                self.set_ttl(name, ttl)
+
+    def _refresh(self, name, now):
+        '''Return (time, value) of a metric, collecting it if expired'''
+        with self._collect_locks[name]:
+            entry = self._values.get(name)
+            if entry is not None and now - entry[0] < self.ttl[name]:
+                with self._lock:
+                    self.hits += 1
+                return entry
+            try:
+                value = self.collectors[name]()
+            except Exception as e:
+                if entry is None:
+                    raise
+                # Keep serving the last value rather than nothing
+                self.log.error(f"Collect {name} error: {e}")
+                return entry
+            entry = (now, value)
+            with self._lock:
+                self.collections += 1
+                self._values[name] = entry
+            return entry
+
+    def get(self, name):
+        '''Get a single metric, collected at most once per ttl'''
+        self._check_name(name)
+        return self._refresh(name, self.clock())[1]
+
+    def snapshot(self, *names):
+        '''
+        Get a Snapshot with the named metrics, all metrics if none given,
+        refreshed if expired.
+        '''
+        if not names:
+            names = METRICS
+        for name in names:
+            self._check_name(name)
+        now = self.clock()
+        timestamp = now
+        values = {}
+        for name in names:
+            collected, values[name] = self._refresh(name, now)
+            timestamp = min(timestamp, collected)
+        with self._lock:
+            for name in METRICS:
+                if name not in values:
+                    entry = self._values.get(name)
+                    values[name] = None if entry is None else entry[1]
+        return Snapshot(timestamp=timestamp, **values)
+
+    def get_stats(self):
+        return {
+            'collections': self.collections,
+            'hits': self.hits,
+        }
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+def get_sampler():
+    '''The process wide sampler shared by all services'''
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = MetricsSampler()
+        return _sampler
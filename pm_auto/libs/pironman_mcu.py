@@ -36,31 +36,90 @@ class ShutdownReason(IntEnum):
     NONE = 0
     BUTTON = 1
 
+# Registers read at once by get_snapshot()
+SNAPSHOT_START = RegisterAddress.FIRMWARE_VERSION
+SNAPSHOT_LENGTH = RegisterAddress.SHUTDOWN_REQ - RegisterAddress.FIRMWARE_VERSION + 1
+
+def decode_firmware_version(data):
+    major = data >> 6 & 0x03
+    minor = data >> 3 & 0x07
+    patch = data & 0x07
+    return (major, minor, patch)
+
+def decode_button(data):
+    if data in BUTTON_MAP:
+        return BUTTON_MAP[data]
+    else:
+        return data
+
+class MCUSnapshot:
+    '''
+    All MCU registers read at one moment.
+
+    firmware_version: (major, minor, patch)
+    default_on: bool
+    button: raw button register, 0 if no button event
+    shutdown_request: ShutdownReason value
+    '''
+    __slots__ = ('firmware_version', 'default_on', 'button', 'shutdown_request')
+
+    def __init__(self, firmware_version, default_on, button, shutdown_request):
+        self.firmware_version = firmware_version
+        self.default_on = default_on
+        self.button = button
+        self.shutdown_request = shutdown_request
+
+    @classmethod
+    def from_registers(cls, data):
+        return cls(
+            firmware_version=decode_firmware_version(data[RegisterAddress.FIRMWARE_VERSION - SNAPSHOT_START]),
+            default_on=data[RegisterAddress.DEFAULT_ON - SNAPSHOT_START] != 0,
+            button=data[RegisterAddress.PWR_BTN - SNAPSHOT_START],
+            shutdown_request=data[RegisterAddress.SHUTDOWN_REQ - SNAPSHOT_START],
+        )
+
+    @property
+    def button_name(self):
+        '''Button event like 'single_click', see BUTTON_MAP'''
+        return decode_button(self.button)
+
+    def __repr__(self):
+        return (f"MCUSnapshot(firmware_version={self.firmware_version}, default_on={self.default_on}, "
+            f"button={self.button}, shutdown_request={self.shutdown_request})")
+
 class PironmanMCU:
     def __init__(self):
         self.i2c = I2C(PM_MCU_I2C_ADDR)
 
+    def get_snapshot(self):
+        '''
+        Read all registers in one block read, then clear the event registers
+        that were set. Returns an MCUSnapshot.
+        '''
+        with self.i2c.transaction():
+            data = self.i2c.read_i2c_block_data(SNAPSHOT_START, SNAPSHOT_LENGTH)
+            for reg in (RegisterAddress.PWR_BTN, RegisterAddress.SHUTDOWN_REQ):
+                if data[reg - SNAPSHOT_START] != 0:
+                    self.i2c.write_byte_data(reg, 0)
+        return MCUSnapshot.from_registers(data)
+
     def get_firmware_version(self):
         data = self.i2c.read_i2c_block_data(RegisterAddress.FIRMWARE_VERSION, 1)[0]
-        major = data >> 6 & 0x03
-        minor = data >> 3 & 0x07
-        patch = data & 0x07
-        return (major, minor, patch)
+        return decode_firmware_version(data)
 
     def get_button(self):
-
-        data = self.i2c.read_i2c_block_data(RegisterAddress.PWR_BTN, 1)[0]
-        self.i2c.write_byte_data(RegisterAddress.PWR_BTN, 0)
-
-        if data in BUTTON_MAP:
-            return BUTTON_MAP[data]
-        else:
-            return data
+        # Read and clear together, so nothing else runs on the bus in between
+        with self.i2c.transaction():
+            data = self.i2c.read_i2c_block_data(RegisterAddress.PWR_BTN, 1)[0]
+            if data != 0:
+                self.i2c.write_byte_data(RegisterAddress.PWR_BTN, 0)
+        return decode_button(data)
     
     def get_shutdown_request(self):
-        data = self.i2c.read_i2c_block_data(RegisterAddress.SHUTDOWN_REQ, 1)[0]
-        if data!= 0:
-            self.i2c.write_byte_data(RegisterAddress.SHUTDOWN_REQ, 0)
+        with self.i2c.transaction():
+            data = self.i2c.read_i2c_block_data(RegisterAddress.SHUTDOWN_REQ, 1)[0]
+            if data!= 0:
+                self.i2c.write_byte_data(RegisterAddress.SHUTDOWN_REQ, 0)
         return data
 
     def get_default_on(self):
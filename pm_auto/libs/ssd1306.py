@@ -21,12 +21,23 @@
 
 
 from __future__ import division
+import errno
+import mmap
+import os
+import struct
+import zlib
 from PIL import Image, ImageDraw, ImageFont
 from importlib.resources import files as resource_files
 
 from .i2c import I2C
+from .cache import LRUCache
 from .utils import run_command
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 __package_name__ = __name__.split('.')[0]
 
 # Constants
@@ -67,6 +78,42 @@ SSD1306_LEFT_HORIZONTAL_SCROLL = 0x27
 SSD1306_VERTICAL_AND_RIGHT_HORIZONTAL_SCROLL = 0x29
 SSD1306_VERTICAL_AND_LEFT_HORIZONTAL_SCROLL = 0x2A
 
+# Framebuffer packing modes
+PACK_PIL = 'pil'       # PIL transpose + tobytes, no extra dependency
+PACK_NUMPY = 'numpy'   # numpy.packbits, needs numpy
+PACK_LOOP = 'loop'     # Plain python loop, slow but always available
+PACK_MODES = [PACK_PIL, PACK_NUMPY, PACK_LOOP]
+
+# Transfer modes
+TRANSFER_RDWR = 'rdwr'     # Whole frame as raw messages in one I2C_RDWR call
+TRANSFER_BLOCK = 'block'   # SMBus I2C block writes, 32 bytes each
+TRANSFER_MODES = [TRANSFER_RDWR, TRANSFER_BLOCK]
+# Errors meaning the adapter can not do I2C_RDWR or messages that large
+TRANSFER_RDWR_UNSUPPORTED = [errno.EINVAL, errno.EOPNOTSUPP, errno.EMSGSIZE, errno.ENOSYS]
+
+SSD1306_CONTROL_COMMAND = 0x00  # Co = 0, D/C = 0, following bytes are commands
+SSD1306_CONTROL_DATA = 0x40     # Co = 0, D/C = 1, following bytes are data
+SMBUS_BLOCK_MAX = 32
+
+# Font cache
+FONT_CACHE_SIZE = 16
+TEXT_LENGTH_CACHE_SIZE = 256
+# Font sizes used by the built-in oled pages, loaded on init
+PRELOAD_FONT_SIZES = [8, 9, 10, 12, 14, 16, 18, 24, 36]
+# Icon cache, maximum bytes of 1 bit icon data kept
+ICON_CACHE_SIZE = 64*1024
+
+# Precompiled icon atlas, see icon_compiler.py
+ICON_ATLAS_FILE = 'icons/icons.atlas'
+ICON_ATLAS_MAGIC = b'PMIA'
+ICON_ATLAS_VERSION = 1
+# magic, version, entry count
+ICON_ATLAS_HEADER = struct.Struct('<4sHH')
+# file name, scale, flags, threshold, width, height, data offset, source crc32
+ICON_ATLAS_ENTRY = struct.Struct('<32sdBBHHII')
+ICON_ATLAS_FLAG_INVERT = 0x01
+ICON_ATLAS_FLAG_DITHER = 0x02
+
 
 class SSD1306Base(object):
     """Base class for SSD1306-based OLED displays.  Implementors should subclass
@@ -79,7 +126,30 @@ class SSD1306Base(object):
         self.width = width
         self.height = height
         self._pages = height//8
-        self._buffer = [0]*(width*self._pages)
+        self._buffer = bytearray(width*self._pages)
+        self.pack_mode = PACK_PIL
+        # Rotation, see set_rotation()
+        self.rotation = 0
+        self._flip = False
+        self._transpose = False
+        self._blank = bytes(width*self._pages)
+        # Copy of what the panel currently shows, used to only send changes
+        self._shadow = bytearray(width*self._pages)
+        # The shadow is valid while its generation is the current one.
+        # force_full_refresh() bumps the generation, so an invalidation from
+        # another thread during a transfer isn't undone by display().
+        self._generation = 0
+        self._shadow_generation = None
+        # Transfer statistics
+        self.frames = 0
+        self.bytes_sent = 0
+        self.bytes_saved = 0
+        self.transfer_mode = TRANSFER_RDWR
+        # Transfer buffer, each window is a data control byte followed by its
+        # data, at most one window per page.
+        self._tx = bytearray(width*self._pages + self._pages)
+        self._tx_view = memoryview(self._tx)
+        self._buffer_view = memoryview(self._buffer)
 
     def _initialize(self):
         raise NotImplementedError
@@ -90,6 +160,19 @@ class SSD1306Base(object):
         control = 0x00   # Co = 0, DC = 0
         self._i2c.write_byte_data(control, c)
 
+    def write_commands(self, commands):
+        """Send several command bytes to display in one transaction."""
+        commands = bytes(commands)
+        if self.transfer_mode == TRANSFER_RDWR:
+            try:
+                self._i2c.write_messages(bytes([SSD1306_CONTROL_COMMAND]) + commands)
+                return
+            except OSError as e:
+                if e.errno not in TRANSFER_RDWR_UNSUPPORTED:
+                    raise
+                self.transfer_mode = TRANSFER_BLOCK
+        self._i2c.write_i2c_block_data(SSD1306_CONTROL_COMMAND, commands)
+
     def write_data(self, c):
         """Send byte of data to display."""
         # I2C write.
@@ -102,6 +185,8 @@ class SSD1306Base(object):
         self._vccstate = vccstate
         # Reset and initialize display.
         self._initialize()
+        # Panel RAM content is unknown after a reset
+        self.force_full_refresh()
         # Turn on the display.
         self.on()
 
@@ -112,18 +197,146 @@ class SSD1306Base(object):
     def off(self):
         self.write_command(SSD1306_DISPLAYOFF)
 
-    def display(self):
-        """Write display buffer to physical display."""
-        self.write_command(SSD1306_COLUMNADDR)
-        self.write_command(0)              # Column start address. (0 = reset)
-        self.write_command(self.width-1)   # Column end address.
-        self.write_command(SSD1306_PAGEADDR)
-        self.write_command(0)              # Page start address. (0 = reset)
-        self.write_command(self._pages-1)  # Page end address.
-        # Write buffer data.
-        for i in range(0, len(self._buffer), 16):
-            control = 0x40   # Co = 0, DC = 0
-            self._i2c.write_i2c_block_data(control, self._buffer[i:i+16])
+    def force_full_refresh(self):
+        """Send the whole buffer on next display() call, regardless of what the
+        panel is supposed to show already.
+        """
+        self._generation += 1
+
+    def display(self, full=False):
+        """Write display buffer to physical display. Only the windows changed
+        since last call are sent, unless full is True or a full refresh is
+        forced.
+        """
+        generation = self._generation
+        if full or self._shadow_generation != generation:
+            windows = [(0, self._pages-1, 0, self.width-1)]
+        else:
+            windows = self._dirty_windows()
+        try:
+            # The whole frame in one bus transaction, so other devices on
+            # the bus can't cut in between its messages
+            with self._i2c.transaction():
+                sent = self._transfer(windows)
+        except Exception:
+            # Part of the frame may be lost, do not trust the shadow anymore
+            self._shadow_generation = None
+            raise
+        self._shadow[:] = self._buffer
+        # Invalidated meanwhile, like a rotation change, the next frame is
+        # sent whole as the generation moved on
+        self._shadow_generation = generation
+        self.frames += 1
+        self.bytes_sent += sent
+        self.bytes_saved += len(self._buffer) - sent
+
+    def set_transfer_mode(self, mode):
+        """Select how frames are sent to the panel, one of TRANSFER_MODES."""
+        if mode not in TRANSFER_MODES:
+            raise ValueError('Invalid transfer mode: {0}'.format(mode))
+        self.transfer_mode = mode
+
+    def _dirty_windows(self):
+        """Compare buffer with shadow, return a list of changed windows as
+        (page_start, page_end, column_start, column_end), inclusive. Adjacent
+        changed pages are merged into one window with their column ranges joined.
+        """
+        width = self.width
+        windows = []
+        for page in range(self._pages):
+            start = page*width
+            new = self._buffer[start:start+width]
+            old = self._shadow[start:start+width]
+            if new == old:
+                continue
+            # XOR as big integers, the lowest and highest set bits give the
+            # first and last changed column without a python loop.
+            diff = int.from_bytes(new, 'little') ^ int.from_bytes(old, 'little')
+            first = ((diff & -diff).bit_length() - 1) // 8
+            last = (diff.bit_length() - 1) // 8
+            if windows and windows[-1][1] == page - 1:
+                page_start, _, first_prev, last_prev = windows[-1]
+                windows[-1] = (page_start, page, min(first, first_prev), max(last, last_prev))
+            else:
+                windows.append((page, page, first, last))
+        return windows
+
+    def _transfer(self, windows):
+        """Send windows of the buffer to the panel, return data bytes sent.
+
+        Every window is an addressing command stream followed by a data
+        message, copied into the transfer buffer without intermediate lists.
+        In TRANSFER_RDWR mode all messages go out in a single I2C_RDWR call,
+        falling back to TRANSFER_BLOCK if the adapter rejects it.
+        """
+        messages = []
+        offset = 0
+        for page_start, page_end, column_start, column_end in windows:
+            commands = bytes([
+                SSD1306_CONTROL_COMMAND,
+                SSD1306_COLUMNADDR, column_start, column_end,
+                SSD1306_PAGEADDR, page_start, page_end,
+            ])
+            start = offset
+            self._tx[offset] = SSD1306_CONTROL_DATA
+            offset += 1
+            length = column_end - column_start + 1
+            for page in range(page_start, page_end+1):
+                source = page*self.width + column_start
+                self._tx_view[offset:offset+length] = self._buffer_view[source:source+length]
+                offset += length
+            messages.append((commands, self._tx_view[start:offset]))
+        sent = offset - len(messages)
+
+        if self.transfer_mode == TRANSFER_RDWR:
+            buffers = []
+            for commands, data in messages:
+                buffers.append(commands)
+                buffers.append(data)
+            try:
+                self._i2c.write_messages(*buffers)
+                return sent
+            except OSError as e:
+                if e.errno not in TRANSFER_RDWR_UNSUPPORTED:
+                    raise
+                self.transfer_mode = TRANSFER_BLOCK
+
+        for commands, data in messages:
+            self._i2c.write_i2c_block_data(commands[0], commands[1:])
+            for i in range(1, len(data), SMBUS_BLOCK_MAX):
+                self._i2c.write_i2c_block_data(SSD1306_CONTROL_DATA, data[i:i+SMBUS_BLOCK_MAX])
+        return sent
+
+    def set_rotation(self, rotation):
+        """Rotate the picture counter clockwise by 0, 90, 180 or 270 degrees,
+        same as Image.rotate without expand. 180 is done once by the controller
+        remapping segments and COM scan direction, 90 is folded into packing
+        the image, and 270 is both. 90 and 270 expect width >= height.
+        """
+        rotation = rotation % 360
+        if rotation not in (0, 90, 180, 270):
+            raise ValueError('Rotation must be a multiple of 90 degrees.')
+        self.rotation = rotation
+        self._flip = rotation in (180, 270)
+        self._transpose = rotation in (90, 270)
+        self.write_commands(self._orientation_commands())
+        self.force_full_refresh()
+
+    def _orientation_commands(self):
+        if self._flip:
+            return [SSD1306_SEGREMAP, SSD1306_COMSCANINC]
+        else:
+            return [SSD1306_SEGREMAP | 0x1, SSD1306_COMSCANDEC]
+
+    def set_pack_mode(self, mode):
+        """Select how images are packed into the display buffer, one of
+        PACK_MODES. All modes produce identical bytes.
+        """
+        if mode not in PACK_MODES:
+            raise ValueError('Invalid pack mode: {0}'.format(mode))
+        if mode == PACK_NUMPY and numpy is None:
+            raise ValueError('Pack mode numpy needs numpy installed.')
+        self.pack_mode = mode
 
     def image(self, image):
         """Set buffer to value of Python Imaging Library image.  The image should
@@ -135,6 +348,55 @@ class SSD1306Base(object):
         if imwidth != self.width or imheight != self.height:
             raise ValueError('Image must be same dimensions as display ({0}x{1}).' \
                 .format(self.width, self.height))
+        self.pack(image, self._buffer)
+
+    def pack(self, image, buffer):
+        """Pack a 1 bit image of display size into buffer, using the SSD1306
+        page layout: one byte per column per page, LSB is the top pixel.
+        """
+        if self.pack_mode == PACK_PIL:
+            self._pack_pil(image, buffer)
+        elif self.pack_mode == PACK_NUMPY:
+            self._pack_numpy(image, buffer)
+        else:
+            self._pack_loop(image, buffer)
+
+    def _pack_pil(self, image, buffer):
+        pages = self._pages
+        width = self.width
+        if self._transpose:
+            # Rotating 90 degrees keeps only the centered square, which turns
+            # every row into a display column, bottom pixel first, on the same
+            # columns. So the cropped square packs just like the case below.
+            start = (width - self.height) // 2
+            end = start + self.height
+            data = image.crop((start, 0, end, self.height)).tobytes()
+            buffer[:] = self._blank
+        else:
+            # Rotating 270 degrees turns every display column into a row, bottom
+            # pixel first. tobytes then packs each 8 pixels MSB first, which gives
+            # exactly the page bytes, only ordered column by column and from the
+            # last page to the first. Strided slices put them in page order.
+            start = 0
+            end = width
+            data = image.transpose(Image.Transpose.ROTATE_270).tobytes()
+        for page in range(pages):
+            buffer[page*width+start:page*width+end] = data[pages-1-page::pages]
+
+    def _pack_numpy(self, image, buffer):
+        pixels = numpy.asarray(image)
+        if self._transpose:
+            start = (self.width - self.height) // 2
+            end = start + self.height
+            rotated = numpy.zeros_like(pixels)
+            rotated[:, start:end] = pixels[:, start:end][:, ::-1].T
+            pixels = rotated
+        pixels = pixels.reshape(self._pages, 8, self.width)
+        buffer[:] = numpy.packbits(pixels, axis=1, bitorder='little').tobytes()
+
+    def _pack_loop(self, image, buffer):
+        if self._transpose:
+            image = image.rotate(90)
         # Grab all the pixels from the image, faster than getpixel.
         pix = image.load()
         # Iterate through the memory pages
@@ -149,12 +411,12 @@ class SSD1306Base(object):
                     bits = bits << 1
                     bits |= 0 if pix[(x, page*8+7-bit)] == 0 else 1
                 # Update buffer byte and increment to next byte.
-                self._buffer[index] = bits
+                buffer[index] = bits
                 index += 1
 
     def clear(self):
         """Clear contents of image buffer."""
-        self._buffer = [0x00]*(self.width*self._pages)
+        self._buffer[:] = bytes(len(self._buffer))
 
     def set_contrast(self, contrast):
         """Sets the contrast of the display.  Contrast should be a value between
@@ -201,8 +463,8 @@ class SSD1306_128_64(SSD1306Base):
             self.write_command(0x14)
         self.write_command(SSD1306_MEMORYMODE)                    # 0x20
         self.write_command(0x00)                                  # 0x0 act like ks0108
-        self.write_command(SSD1306_SEGREMAP | 0x1)
-        self.write_command(SSD1306_COMSCANDEC)
+        for command in self._orientation_commands():         # 0xA0/0xA1, 0xC0/0xC8
+            self.write_command(command)
         self.write_command(SSD1306_SETCOMPINS)                    # 0xDA
         self.write_command(0x12)
         self.write_command(SSD1306_SETCONTRAST)                   # 0x81
@@ -238,6 +500,70 @@ class Rect:
     def rect(self, pecent=100):
         return (self.x, self.y, self.x + int(self.width*pecent/100.0), self.y2)
 
+class IconAtlas():
+    '''
+    Read only, memory mapped atlas of precompiled 1 bit icons. Icons are
+    stored as raw mode 1 rows, so drawing one needs no image decoding and the
+    mapped pages are shared by every process using the same atlas.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._index = {}
+        self._verified = {}
+        # Images decoded from the atlas by key, at most one per entry
+        self._images = {}
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = ICON_ATLAS_HEADER.unpack_from(self._mmap, 0)
+        if magic != ICON_ATLAS_MAGIC or version != ICON_ATLAS_VERSION:
+            self._mmap.close()
+            raise ValueError(f'Invalid icon atlas: {path}')
+        offset = ICON_ATLAS_HEADER.size
+        for _ in range(count):
+            name, scale, flags, threshold, width, height, data_offset, crc = \
+                ICON_ATLAS_ENTRY.unpack_from(self._mmap, offset)
+            offset += ICON_ATLAS_ENTRY.size
+            name = name.rstrip(b'\0').decode()
+            invert = bool(flags & ICON_ATLAS_FLAG_INVERT)
+            dither = bool(flags & ICON_ATLAS_FLAG_DITHER)
+            key = icon_atlas_key(name, scale, invert, dither, threshold)
+            self._index[key] = (width, height, data_offset, crc)
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, icon, scale=1.0, invert=False, dither=True, threshold=127):
+        '''
+        Get an icon as 1 bit image, None if the variant is not in the atlas or
+        the source file differs from the one it was compiled from.
+        '''
+        icon = str(icon)
+        key = icon_atlas_key(os.path.basename(icon), scale, invert, dither, threshold)
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        width, height, data_offset, crc = entry
+        # Only compare the source once per path, no decoding needed for it
+        if (icon, crc) not in self._verified:
+            try:
+                with open(icon, 'rb') as f:
+                    self._verified[(icon, crc)] = zlib.crc32(f.read()) == crc
+            except OSError:
+                self._verified[(icon, crc)] = False
+        if not self._verified[(icon, crc)]:
+            return None
+        img = self._images.get(key)
+        if img is None:
+            size = (width + 7) // 8 * height
+            data = self._mmap[data_offset:data_offset+size]
+            img = Image.frombytes('1', (width, height), data)
+            self._images[key] = img
+        return img
+
+    def close(self):
+        self._images.clear()
+        self._mmap.close()
+
 class I2cNotEnabled(Exception):
     """I2C总线未启用的异常"""
     def __init__(self, message="I2C interface not enabled"):
@@ -262,6 +588,11 @@ class SSD1306():
         self._is_ready = False
         self.oled = None
         self.rotation = 0
+        self.font_cache = LRUCache(FONT_CACHE_SIZE)
+        self.text_length_cache = LRUCache(TEXT_LENGTH_CACHE_SIZE)
+        self.icon_cache = LRUCache(ICON_CACHE_SIZE, sizeof=lambda entry: icon_size(entry[1]))
+        self.icon_atlas = None
+        self.pipeline = None
         if not I2C.enabled():
             raise I2cNotEnabled()
         addresses = self.check_oled()
@@ -272,19 +603,41 @@ class SSD1306():
         self._is_ready = True
 
     def set_rotation(self, rotation):
-        self.rotation = rotation
+        # Multiples of 90 are handled by the display, no per frame work
+        if rotation % 90 == 0:
+            self.oled.set_rotation(rotation)
+            self.rotation = 0
+        else:
+            self.oled.set_rotation(0)
+            self.rotation = rotation
+        # 180 degrees apart pack the same bytes, the pipeline would skip
+        # the next frame as unchanged and leave the panel mirrored
+        self.force_full_refresh()
+
+    def force_full_refresh(self):
+        self.oled.force_full_refresh()
+        if self.pipeline is not None:
+            self.pipeline.invalidate()
+
+    def set_pipeline(self, pipeline):
+        '''
+        Hand frames to a FramePipeline instead of sending them in display().
+        None to send synchronously again.
+        '''
+        self.pipeline = pipeline
+
+    def get_stats(self):
+        return {
+            'frames': self.oled.frames,
+            'bytes_sent': self.oled.bytes_sent,
+            'bytes_saved': self.oled.bytes_saved,
+        }
 
     def is_ready(self):
         return self._is_ready
 
     def check_oled(self):
-        addressed = I2C.scan()
-        result = []
-        if SSD1306_I2C_ADDRESS_1 in addressed:
-            result.append(SSD1306_I2C_ADDRESS_1)
-        if SSD1306_I2C_ADDRESS_2 in addressed:
-            result.append(SSD1306_I2C_ADDRESS_2)
-        return result
+        return I2C.probe([SSD1306_I2C_ADDRESS_1, SSD1306_I2C_ADDRESS_2])
 
     def init(self):
         self.width = self.oled.width
@@ -297,23 +650,57 @@ class SSD1306():
         self.draw = ImageDraw.Draw(self.image)
         # self.font_path = str(resource_files(__package_name__).joinpath('fonts/Minecraftia-Regular.ttf'))
         self.font_path = str(resource_files(__package_name__).joinpath('fonts/UbuntuSans-Regular.ttf'))
+        for size in PRELOAD_FONT_SIZES:
+            self.get_font(size)
+        atlas_path = str(resource_files(__package_name__).joinpath(ICON_ATLAS_FILE))
+        if os.path.exists(atlas_path):
+            try:
+                self.icon_atlas = IconAtlas(atlas_path)
+            except (OSError, ValueError, struct.error):
+                self.icon_atlas = None
+
+    def get_font(self, size, font_path=None):
+        if font_path is None:
+            font_path = self.font_path
+        key = (font_path, size)
+        font = self.font_cache.get(key)
+        if font is None:
+            font = ImageFont.truetype(font_path, size)
+            self.font_cache.put(key, font)
+        return font
 
+    def get_text_length(self, text, size, font_path=None):
+        if font_path is None:
+            font_path = self.font_path
+        key = (font_path, size, text)
+        length = self.text_length_cache.get(key)
+        if length is None:
+            length = self.get_font(size, font_path).getlength(text)
+            self.text_length_cache.put(key, length)
+        return length
+
+    def get_cache_stats(self):
+        return {
+            'font': self.font_cache.get_stats(),
+            'text_length': self.text_length_cache.get_stats(),
+            'icon': self.icon_cache.get_stats(),
+        }
 
     def clear(self):
         self.draw.rectangle((0, 0, self.width, self.height), outline=0, fill=0)
-        self.oled.clear()
+        if self.pipeline is not None and self.pipeline.running:
+            # The panel buffer belongs to the transfer thread now
+            self.pipeline.begin_frame()
+        else:
+            self.oled.clear()
 
     def draw_text(self, text, x, y, fill=1, align='left', size=8, font_path=None):
         text = str(text)
-        if font_path is None:
-            font = ImageFont.truetype(self.font_path, size)
-        else:
-            font = ImageFont.truetype(font_path, size)
-        text_width = font.getlength(text)
+        font = self.get_font(size, font_path)
         if align == 'center':
-            x -= text_width / 2
+            x -= self.get_text_length(text, size, font_path) / 2
         elif align == 'right':
-            x -= text_width
+            x -= self.get_text_length(text, size, font_path)
         self.draw.text((x, y), text=text, font=font, fill=fill)
 
     def draw_bar_graph_horizontal(self, percent, x, y, width, height):
@@ -338,42 +725,37 @@ class SSD1306():
         self.draw.pieslice((x-r, y-r, x+r, y+r), start=start, end=value_end, fill=1, outline=1)
 
     def draw_icon(self, icon, x, y, scale=1.0, invert=False,  dither=True, threshold=127):
-        img = Image.open(icon)
-
-        if img.mode != 'RGBA':
-            img = img.convert('RGBA')
-
-        # 缩放
-        if scale != 1.0:
-            new_width = int(img.width * scale)
-            new_height = int(img.height * scale)
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-
-        # 处理透明背景
-        r, g, b, a = img.split()
-        white = Image.new('L', img.size, 255)
-        converted_img = Image.merge('RGBA', (white, white, white, a))
-        background = Image.new('RGBA', img.size, (0, 0, 0, 255))
-        final_img = Image.alpha_composite(background, converted_img)
-
-        if not dither:
-            # 直接阈值法（无抖动）
-            final_img = final_img.convert('L')  # 转换为灰度图
-            final_img = final_img.point(lambda p: 255 if p > threshold else 0)
+        img = None
+        if isinstance(icon, (str, os.PathLike)):
+            if self.icon_atlas is not None:
+                img = self.icon_atlas.get(icon, scale, invert, dither, threshold)
+            if img is None:
+                img = self.get_icon(icon, scale, invert, dither, threshold)
         else:
-            # 抖动算法（生成更平滑的黑白效果）
-            final_img = final_img.convert('1', dither=Image.Dither.FLOYDSTEINBERG)
-
-        # 反转
-        if invert:
-                final_img = Image.eval(final_img, lambda x: 255 - x)
-
+            img = render_icon(icon, scale, invert, dither, threshold)
         # 绘制到画布上
-        self.image.paste(final_img, (x, y), None)
+        self.image.paste(img, (x, y), None)
 
+    def get_icon(self, icon, scale=1.0, invert=False, dither=True, threshold=127):
+        '''
+        Get the rendered 1 bit icon from cache, render it if not cached or the
+        file changed since.
+        '''
+        key = (str(icon), scale, invert, dither, threshold)
+        mtime = os.stat(icon).st_mtime_ns
+        entry = self.icon_cache.get(key)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, render_icon(icon, scale, invert, dither, threshold))
+            self.icon_cache.put(key, entry)
+        return entry[1]
 
     def display(self):
-        image = self.image.rotate(self.rotation)
+        image = self.image
+        if self.rotation != 0:
+            image = image.rotate(self.rotation)
+        if self.pipeline is not None and self.pipeline.running:
+            self.pipeline.submit(image)
+            return
         self.oled.image(image)
         # save image to file for debug
         # image.save('/tmp/oled.png')
@@ -382,3 +764,51 @@ class SSD1306():
     def off(self):
         self.oled.off()
 
+def icon_atlas_key(name, scale, invert, dither, threshold):
+    '''Atlas lookup key, threshold is not used when dithering'''
+    if dither:
+        threshold = 0
+    return (name, float(scale), bool(invert), bool(dither), int(threshold))
+
+def icon_size(img):
+    '''Bytes used by a 1 bit image'''
+    return (img.width + 7) // 8 * img.height
+
+def render_icon(icon, scale=1.0, invert=False,  dither=True, threshold=127):
+    '''
+    Load an icon and turn it into a 1 bit image for the OLED, transparent
+    background as black.
+    '''
+    img = Image.open(icon)
+
+    if img.mode != 'RGBA':
+        img = img.convert('RGBA')
+
+    # 缩放
+    if scale != 1.0:
+        new_width = int(img.width * scale)
+        new_height = int(img.height * scale)
+        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+
+    # 处理透明背景
+    r, g, b, a = img.split()
+    white = Image.new('L', img.size, 255)
+    converted_img = Image.merge('RGBA', (white, white, white, a))
+    background = Image.new('RGBA', img.size, (0, 0, 0, 255))
+    final_img = Image.alpha_composite(background, converted_img)
+
+    if not dither:
+        # 直接阈值法（无抖动）
+        final_img = final_img.convert('L')  # 转换为灰度图
+        final_img = final_img.point(lambda p: 255 if p > threshold else 0)
+        # 已经只有黑白两色，转换时不需要再抖动
+        final_img = final_img.convert('1', dither=Image.Dither.NONE)
+    else:
+        # 抖动算法（生成更平滑的黑白效果）
+        final_img = final_img.convert('1', dither=Image.Dither.FLOYDSTEINBERG)
+
+    # 反转
+    if invert:
+            final_img = Image.eval(final_img, lambda x: 255 - x)
+
+    return final_img
@@ -0,0 +1,343 @@
+# Sysfs and procfs collectors
+#
+# Lightweight readers for the system files polled every second. Paths are
+# resolved once and files are kept open, each read is a single os.pread from
+# offset 0, which makes the kernel regenerate the content without reopening
+# the file. Writers work the same way and only write values that changed.
+# All paths are relative to a root, "/" by default, so the readers can run
+# against a fake tree.
+#
+import os
+import glob
+from collections import namedtuple
+
+ROOT = '/'
+
+THERMAL_ZONE_TEMP = '/sys/class/thermal/thermal_zone{zone}/temp'
+THERMAL_ZONES = '/sys/class/thermal/thermal_zone[0-9]*'
+PROC_STAT = '/proc/stat'
+PROC_MEMINFO = '/proc/meminfo'
+COOLING_DEVICE_STATE = '/sys/class/thermal/cooling_device{device}/cur_state'
+COOLING_FAN = '/sys/devices/platform/cooling_fan'
+COOLING_FAN_HWMON = '/sys/devices/platform/cooling_fan/hwmon'
+HWMON_CLASS = '/sys/class/hwmon'
+CPUFREQ = '/sys/devices/system/cpu/cpu[0-9]*/cpufreq'
+# Raspberry Pi firmware throttle flags, same as vcgencmd get_throttled
+FIRMWARE_THROTTLED = '/sys/devices/platform/soc/soc:firmware/get_throttled'
+
+THROTTLE_FLAGS = {
+    0x1: 'under_voltage',
+    0x2: 'arm_freq_capped',
+    0x4: 'throttled',
+    0x8: 'soft_temp_limit',
+}
+
+# hwmon devices with a temperature worth cooling for
+HWMON_SENSORS = ['nvme', 'rp1_adc']
+
+Sensor = namedtuple('Sensor', ['name', 'kind', 'path'])
+Sensor.__doc__ = '''
+A temperature sensor. kind is the thermal zone type, like cpu-thermal, or
+the hwmon name, like nvme. name is unique: thermal_zone<n> for zones,
+<hwmon name><n> for hwmon sensors, numbered per name.
+'''
+
+MemoryInfo = namedtuple('MemoryInfo', ['total', 'available', 'used', 'percent'])
+
+def root_path(root, path):
+    '''Join an absolute system path onto root'''
+    return os.path.join(root, path.lstrip('/'))
+
+class SysfsFile():
+    '''
+    A sysfs or procfs file kept open. Every read() returns fresh content
+    with one pread syscall.
+
+    size: maximum bytes read, files longer than that are truncated
+    '''
+    def __init__(self, path, size=4096):
+        self.path = path
+        self.size = size
+        self.fd = None
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def read(self):
+        return os.pread(self.fd, self.size, 0).decode()
+
+    def read_int(self):
+        return int(os.pread(self.fd, self.size, 0))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        self.close()
+
+class SysfsWriter():
+    '''
+    A sysfs attribute kept open for writing. write() only writes when the
+    value differs from the last one written. Opening raises PermissionError
+    if the process may not write the attribute.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.fd = os.open(path, os.O_WRONLY)
+        self.value = None
+        self.writes = 0
+
+    def write(self, value, force=False):
+        '''Write value if changed or forced, return True if written'''
+        value = str(value)
+        if value == self.value and not force:
+            return False
+        os.pwrite(self.fd, value.encode(), 0)
+        self.value = value
+        self.writes += 1
+        return True
+
+    def invalidate(self):
+        '''Write the next value even if unchanged'''
+        self.value = None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        self.close()
+
+def find_hwmon(name, root=ROOT):
+    '''Find the hwmon directory whose name file matches name, None if none'''
+    for path in sorted(glob.glob(root_path(root, HWMON_CLASS) + '/hwmon*')):
+        try:
+            with open(os.path.join(path, 'name')) as f:
+                if f.read().strip() == name:
+                    return path
+        except OSError:
+            pass
+    return None
+
+def find_fan_input(root=ROOT):
+    '''Path of the Raspberry Pi 5 cooling fan speed input, None if no fan'''
+    paths = sorted(glob.glob(root_path(root, COOLING_FAN_HWMON) + '/hwmon*/fan1_input'))
+    if len(paths) == 0:
+        return None
+    return paths[0]
+
+def discover_sensors(root=ROOT, hwmon_names=HWMON_SENSORS):
+    '''List the Sensors of all thermal zones and of hwmon devices in hwmon_names'''
+    sensors = []
+    for path in sorted(glob.glob(root_path(root, THERMAL_ZONES))):
+        try:
+            with open(os.path.join(path, 'type')) as f:
+                kind = f.read().strip()
+        except OSError:
+            continue
+        sensors.append(Sensor(os.path.basename(path), kind, os.path.join(path, 'temp')))
+    counts = {}
+    for path in sorted(glob.glob(root_path(root, HWMON_CLASS) + '/hwmon*')):
+        try:
+            with open(os.path.join(path, 'name')) as f:
+                kind = f.read().strip()
+        except OSError:
+            continue
+        temp_input = os.path.join(path, 'temp1_input')
+        if kind not in hwmon_names or not os.path.exists(temp_input):
+            continue
+        n = counts.get(kind, 0)
+        counts[kind] = n + 1
+        sensors.append(Sensor(f'{kind}{n}', kind, temp_input))
+    return sensors
+
+class ThermalSensors():
+    '''
+    Temperature sensors discovered once, each read through a persistent fd
+    opened on first read.
+    '''
+    def __init__(self, root=ROOT, hwmon_names=HWMON_SENSORS):
+        self.sensors = discover_sensors(root, hwmon_names)
+        self._files = {}
+
+    def read(self, names=None):
+        '''
+        Temperatures in Celsius by sensor name, all sensors or only names.
+        Sensors failing to read, like a drive in power saving, are left out.
+        '''
+        temperatures = {}
+        for sensor in self.sensors:
+            if names is not None and sensor.name not in names:
+                continue
+            try:
+                file = self._files.get(sensor.name)
+                if file is None:
+                    file = SysfsFile(sensor.path, size=32)
+                    self._files[sensor.name] = file
+                temperatures[sensor.name] = file.read_int() / 1000
+            except (OSError, ValueError):
+                pass
+        return temperatures
+
+class ThermalZone():
+    def __init__(self, zone=0, root=ROOT):
+        self.file = SysfsFile(root_path(root, THERMAL_ZONE_TEMP.format(zone=zone)), size=32)
+
+    def read(self):
+        '''Temperature in Celsius'''
+        return round(self.file.read_int() / 1000, 2)
+
+class CPUPercent():
+    '''CPU usage from /proc/stat deltas between two reads'''
+    def __init__(self, root=ROOT):
+        # Only the first, aggregated cpu line is needed
+        self.file = SysfsFile(root_path(root, PROC_STAT), size=256)
+        self.last_total = 0
+        self.last_idle = 0
+
+    def read(self):
+        '''Percent of CPU time busy since last read, since boot on first read'''
+        line = self.file.read().split('\n', 1)[0]
+        # cpu user nice system idle iowait irq softirq steal guest guest_nice
+        fields = [int(x) for x in line.split()[1:9]]
+        total = sum(fields)
+        idle = fields[3] + fields[4]
+        delta_total = total - self.last_total
+        delta_idle = idle - self.last_idle
+        self.last_total = total
+        self.last_idle = idle
+        if delta_total <= 0:
+            return 0.0
+        return round(100 * (delta_total - delta_idle) / delta_total, 1)
+
+class Meminfo():
+    def __init__(self, root=ROOT):
+        self.file = SysfsFile(root_path(root, PROC_MEMINFO))
+
+    def read(self):
+        '''Memory info in bytes, used is everything not available'''
+        values = {}
+        for line in self.file.read().splitlines():
+            key, _, value = line.partition(':')
+            if key in ('MemTotal', 'MemAvailable'):
+                values[key] = int(value.split()[0]) * 1024
+                if len(values) == 2:
+                    break
+        total = values['MemTotal']
+        available = values['MemAvailable']
+        used = total - available
+        percent = round(used / total * 100, 1) if total > 0 else 0.0
+        return MemoryInfo(total=total, available=available, used=used, percent=percent)
+
+class FanSpeed():
+    def __init__(self, root=ROOT):
+        path = find_fan_input(root)
+        self.file = None if path is None else SysfsFile(path, size=32)
+
+    def read(self):
+        '''Fan speed in RPM, 0 if there is no fan'''
+        if self.file is None:
+            return 0
+        return self.file.read_int()
+
+class ThrottleDetector():
+    '''
+    Detect CPU frequency capping. A cpufreq policy counts as capped when its
+    scaling_max_freq drops below the value seen at startup, or, while the CPU
+    is busy, when scaling_cur_freq is below busy_ratio of scaling_max_freq. A
+    cap set on purpose before startup, like cpufreq-set -u, isn't throttling.
+    The firmware throttle flags and the rpi_volt under voltage alarm are read
+    too where available.
+
+    busy_ratio: fraction of scaling_max_freq a busy CPU should run at
+    '''
+    def __init__(self, root=ROOT, busy_ratio=0.9):
+        self.busy_ratio = busy_ratio
+        # One entry per policy, cpus sharing one link to the same directory
+        self.policies = []
+        # scaling_max_freq by cpu at startup, raised if it goes up later
+        self.max_freq_baseline = {}
+        seen = set()
+        for path in sorted(glob.glob(root_path(root, CPUFREQ))):
+            real_path = os.path.realpath(path)
+            if real_path in seen:
+                continue
+            seen.add(real_path)
+            cpu = os.path.basename(os.path.dirname(path))
+            try:
+                max_freq = SysfsFile(os.path.join(path, 'scaling_max_freq'), size=32)
+                self.policies.append((
+                    cpu,
+                    SysfsFile(os.path.join(path, 'scaling_cur_freq'), size=32),
+                    max_freq,
+                ))
+                self.max_freq_baseline[cpu] = max_freq.read_int()
+            except (OSError, ValueError):
+                pass
+        self.firmware = None
+        try:
+            self.firmware = SysfsFile(root_path(root, FIRMWARE_THROTTLED), size=32)
+        except OSError:
+            pass
+        self.under_voltage = None
+        hwmon = find_hwmon('rpi_volt', root)
+        if hwmon is not None:
+            try:
+                self.under_voltage = SysfsFile(os.path.join(hwmon, 'in0_lcrit_alarm'), size=16)
+            except OSError:
+                pass
+
+    def is_available(self):
+        return len(self.policies) > 0 or self.firmware is not None
+
+    def read(self, busy=False):
+        '''List of throttle reasons, empty if not throttled'''
+        reasons = []
+        for cpu, cur_freq, max_freq in self.policies:
+            scaling_max = max_freq.read_int()
+            baseline = self.max_freq_baseline[cpu]
+            if scaling_max > baseline:
+                self.max_freq_baseline[cpu] = scaling_max
+            elif scaling_max < baseline:
+                reasons.append(f'{cpu}_max_freq_capped')
+            elif busy and cur_freq.read_int() < scaling_max * self.busy_ratio:
+                reasons.append(f'{cpu}_freq_capped')
+        if self.firmware is not None:
+            flags = int(self.firmware.read().strip() or '0', 16)
+            for bit, name in THROTTLE_FLAGS.items():
+                if flags & bit:
+                    reasons.append(name)
+        if self.under_voltage is not None and self.under_voltage.read_int() \
+                and 'under_voltage' not in reasons:
+            reasons.append('under_voltage')
+        return reasons
+
+class SystemCollectors():
+    '''
+    Native collectors for the metrics sampler. Readers are opened on first
+    use, so metrics nobody asks for cost nothing.
+    '''
+    def __init__(self, root=ROOT):
+        self.root = root
+        self._readers = {}
+
+    def _reader(self, name, cls):
+        reader = self._readers.get(name)
+        if reader is None:
+            reader = cls(root=self.root)
+            self._readers[name] = reader
+        return reader
+
+    def cpu_temperature(self):
+        return self._reader('cpu_temperature', ThermalZone).read()
+
+    def cpu_percent(self):
+        return self._reader('cpu_percent', CPUPercent).read()
+
+    def memory(self):
+        return self._reader('memory', Meminfo).read()
+
+    def fan_speed(self):
+        return self._reader('fan_speed', FanSpeed).read()
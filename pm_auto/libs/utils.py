@@ -1,3 +1,6 @@
+from functools import lru_cache
+
+OS_RELEASE_PATHS = ['/etc/os-release', '/usr/lib/os-release']
 
 def map_value(x, from_min, from_max, to_min, to_max):
     return (x - from_min) * (to_max - to_min) / (from_max - from_min) + to_min
@@ -18,6 +21,28 @@ def run_command(cmd):
     status = p.poll()
     return status, result
 
+@lru_cache(maxsize=None)
+def get_os_release():
+    '''
+    Fields of os-release, like ID and VERSION_CODENAME, as a dict. Parsed
+    once per process, empty if there is no os-release file.
+    '''
+    for path in OS_RELEASE_PATHS:
+        try:
+            with open(path, 'r') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        info = {}
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            info[key.strip()] = value.strip().strip('"\'')
+        return info
+    return {}
+
 def format_bytes_auto(size):
     # 定义字节单位
     units = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
@@ -1,13 +1,8 @@
-from sf_rpi_status import \
-    get_cpu_temperature, \
-    get_cpu_percent, \
-    get_memory_info, \
-    get_disks_info, \
-    get_ips
 import time
 
 from .oled_config import *
 from .uilts import *
+from ..libs.metrics import get_sampler
 
 last_ips = {}
 ip_index = 0
@@ -16,19 +11,20 @@ ip_show_next_timestamp = 0
 def get_data():
     global ip_index
 
-    memory_info = get_memory_info()
-    ips = get_ips()
+    metrics = get_sampler().snapshot()
+    memory_info = metrics.memory
+    ips = metrics.ips
 
     data = {
-        'cpu_temperature': get_cpu_temperature(),
-        'cpu_percent': get_cpu_percent(),
+        'cpu_temperature': metrics.cpu_temperature,
+        'cpu_percent': metrics.cpu_percent,
         'memory_total': memory_info.total,
         'memory_used': memory_info.used,
         'memory_percent': memory_info.percent,
         'ips': []
     }
     # Get disk info
-    disks_info = get_disks_info()
+    disks_info = metrics.disks
     data['disk_total'] = 0
     data['disk_used'] = 0
     data['disk_percent'] = 0
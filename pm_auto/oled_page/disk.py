@@ -1,6 +1,6 @@
-from sf_rpi_status import get_disks_info
 from .oled_config import *
 from .uilts import *
+from ..libs.metrics import get_sampler
 
 from pathlib import Path
 grandparent_dir = Path(__file__).resolve().parent.parent
@@ -9,7 +9,7 @@ nvme_icon = str(grandparent_dir) + '/icons/nvme_icon_20.png'
 usb_stick_icon = str(grandparent_dir) + '/icons/usb_stick_icon_20.png'
 
 def oled_page_disk(oled):
-    disks_info = get_disks_info()
+    disks_info = get_sampler().get('disks')
 
     oled.clear()
 
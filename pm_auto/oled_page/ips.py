@@ -1,12 +1,7 @@
-from sf_rpi_status import \
-    get_cpu_temperature, \
-    get_cpu_percent, \
-    get_memory_info, \
-    get_disks_info, \
-    get_ips
 import time
 
 from.oled_config import *
+from ..libs.metrics import get_sampler
 
 
 from pathlib import Path
@@ -16,7 +11,8 @@ wifi_icon = str(grandparent_dir) + '/icons/wifi_icon_20.png'
 net_icon = str(grandparent_dir) + '/icons/net_icon_20.png'
 
 def oled_page_ips(oled):
-    ips = get_ips()
+    # Snapshot is read only, copy before adding loopback
+    ips = dict(get_sampler().get('ips'))
     ips['lo'] = '127.0.0.1'
     oled.clear()
 
@@ -1,15 +1,8 @@
-from sf_rpi_status import \
-    get_cpu_temperature, \
-    get_cpu_percent, \
-    get_memory_info, \
-    get_disks_info, \
-    get_ips, \
-    PWMFan
-
 import time
 
 from .oled_config import *
 from .uilts import *
+from ..libs.metrics import get_sampler
 
 from pathlib import Path
 grandparent_dir = Path(__file__).resolve().parent.parent
@@ -18,27 +11,25 @@ ram_icon = str(grandparent_dir) + '/icons/ram_icon_24.png'
 temp_icon = str(grandparent_dir) + '/icons/temperature_icon_24.png'
 fan_icon = str(grandparent_dir) + '/icons/fan_icon_24.png'
 
-pwm_fan = PWMFan()
-
 def oled_page_performance(oled):
-    cpu_temp_c = get_cpu_temperature()
+    metrics = get_sampler().snapshot('cpu_temperature', 'cpu_percent', 'memory', 'fan_speed')
+    cpu_temp_c = metrics.cpu_temperature
     cpu_temp_f = cpu_temp_c * 9 / 5 + 32
-    cpu_usage = get_cpu_percent()
+    cpu_usage = metrics.cpu_percent
     if cpu_usage >= 100:
         cpu_usage = 100
 
     temp = cpu_temp_c if temperature_unit == 'C' else cpu_temp_f
     temp_percent = temp
 
-    memory_info = get_memory_info()
+    memory_info = metrics.memory
     memory_total, memory_unit = format_bytes( memory_info.total)
     memory_used = format_bytes(memory_info.used, memory_unit)
     memory_percent =  memory_info.percent
     if memory_percent >= 100:
         memory_percent = 100
 
-    # pwm_fan.set_state(4)
-    fan_speed = pwm_fan.get_speed()
+    fan_speed = metrics.fan_speed
 
 
     oled.clear()
@@ -2,6 +2,7 @@ import time
 import threading
 
 from .libs.utils import has_common_items, log_error
+from .libs.metrics import get_sampler
 
 
 app_name = 'pm_auto'
@@ -22,8 +23,10 @@ DEFAULT_CONFIG = {
     'gpio_fan_mode': 1,
     'gpio_fan_led_pin': 5,
     "gpio_fan_pin": 6,
+    'fan_control_mode': 'step',  # 'step', 'jump', 'curve' or 'pid', see libs/fan_controller.py
     'vibration_switch_pin': 26,
     'vibration_switch_pull_up': False,
+    'pironman_mcu_interrupt_pin': None,  # GPIO of the MCU interrupt line, None to poll the MCU
 }
 
 class PMAuto():
@@ -43,6 +46,8 @@ class PMAuto():
         self.vibration_switch = None
         self.pironman_mcu = None
 
+        get_sampler().update_config(config)
+
         if 'oled' in peripherals:
             from .services.oled_service import OLEDService
             self.log.debug("Initializing OLED service")
@@ -134,6 +139,12 @@ class PMAuto():
         self.__on_state_changed__ = callback
         self.fan.set_on_state_changed(callback)
 
+    @log_error
+    def get_i2c_stats(self):
+        '''I2C transaction statistics by bus, device address and operation'''
+        from .libs.i2c import get_stats
+        return get_stats()
+
     @log_error
     def is_ready(self):
         return self._is_ready
@@ -141,6 +152,7 @@ class PMAuto():
     @log_error
     def update_config(self, config):
         self.log.debug(f"Update config: {config}")
+        get_sampler().update_config(config)
         if 'oled' in self.peripherals:
             self.oled.update_config(config)
         if 'ws2812' in self.peripherals:
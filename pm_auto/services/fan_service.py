@@ -1,17 +1,35 @@
 import logging
 import subprocess
-import os
 import time
 import threading
 
-from ..libs.utils import run_command, log_error
+from ..libs.utils import get_os_release, log_error, has_common_items
+from ..libs.metrics import get_sampler, MetricsSampler
+from ..libs.fan_controller import FanController, TemperatureFilter, CONTROL_CURVE, \
+    DEFAULT_CURVE, DEFAULT_PID, DEFAULT_SENSOR_CURVES
+from ..libs.sysfs import SysfsFile, SysfsWriter, FanSpeed, ThrottleDetector, ThermalSensors, root_path, ROOT, \
+    COOLING_DEVICE_STATE, COOLING_FAN
 
 default_config = {
     "gpio_fan_pin": 6,
     "gpio_fan_led_pin": 5,
     "gpio_fan_led": 'follow',
     "gpio_fan_mode": 1,
+    "fan_keep_alive": 60,
+    "fan_control_mode": 'step', # 'step', 'jump', 'curve' or 'pid'
+    "fan_curve": DEFAULT_CURVE,
+    "fan_hysteresis": 2,
+    "fan_min_dwell": 0,
+    "fan_pid": DEFAULT_PID,
+    "fan_filter_window": 10, # samples used for the temperature slope
+    "fan_filter_alpha": 0.3, # EMA weight of a falling temperature sample, 1 for no smoothing, rises are never smoothed
+    "fan_predict_seconds": 0, # Act on the temperature this far ahead, 0 to disable
+    # Curves of other temperature sensors by sensor name or kind, like nvme0
+    # or nvme, the fan runs at the highest duty any sensor asks for
+    "fan_sensor_curves": DEFAULT_SENSOR_CURVES,
 }
+CONTROLLER_CONFIG = ['fan_control_mode', 'fan_curve', 'fan_hysteresis', 'fan_min_dwell', 'fan_pid', 'fan_sensor_curves']
+FILTER_CONFIG = ['fan_filter_window', 'fan_filter_alpha']
 
 FANS = [
     'pwm_fan', # Deprecated
@@ -49,10 +67,22 @@ FAN_LEVELS = [
 ]
 
 INTERVAL = 1
+# CPU percent above which a CPU below its max frequency counts as throttled
+THROTTLE_BUSY_PERCENT = 90
+# State entries changing every tick, published but not a reason to call the
+# state callback on their own
+STATE_UNTRACKED = ['cpu_temperature_filtered', 'cpu_temperature_slope']
+# Throttle reasons the fan can't help with. Under voltage also sets the
+# firmware throttle flags, no boost at all while one of these is present.
+THROTTLE_NO_BOOST = ['under_voltage']
 
 class FanService:
     @log_error
-    def __init__(self, config, fans=[], get_logger=None):
+    def __init__(self, config, fans=[], get_logger=None, root=ROOT, clock=time.monotonic):
+        '''
+        root: root of the sysfs tree, "/" unless testing against a fake tree
+        clock: monotonic time source, replaced by the fan simulator
+        '''
         if get_logger is None:
             get_logger = logging.getLogger
         self.log = get_logger(__name__)
@@ -60,37 +90,57 @@ class FanService:
         self.gpio_fan = Fan()
         self.spc_fan = Fan()
         self.pwm_fan = Fan()
-        self.config = default_config
+        self.clock = clock
+        self.config = dict(default_config)
+        # The shared sampler reads the real system, a fake tree needs its own
+        if root == ROOT:
+            self.sampler = get_sampler()
+        else:
+            self.sampler = MetricsSampler(root=root, log=self.log, clock=clock)
 
         self.temperature_unit = 'C'
         self.interval = 1
+        self.controller = None
+        self.sensor_controllers = {}
+        self.filter = None
+        self.sensors = ThermalSensors(root=root)
+        self.log.debug(f"Thermal sensors: {[sensor.name for sensor in self.sensors.sensors]}")
         self.update_config(config)
+        if self.controller is None:
+            self.controller = self.build_controller(self.config)
+            self.sensor_controllers = self.build_sensor_controllers(self.config)
+        if self.filter is None:
+            self.filter = TemperatureFilter(self.config['fan_filter_window'], self.config['fan_filter_alpha'])
+        keep_alive = self.config["fan_keep_alive"]
 
         if 'gpio_fan_state' in fans or 'gpio_fan' in fans: # gpio_fan is deprecated, use gpio_fan_state instead
             pin = self.config["gpio_fan_pin"]
             if 'gpio_fan_led' in fans:
                 led_pin = self.config["gpio_fan_led_pin"]
                 self.log.debug(f"Init GPIO Fan with pin: {pin}, led_pin: {led_pin}")
-                self.gpio_fan = GPIOFan(pin, led_pin=led_pin, log=self.log)
+                self.gpio_fan = GPIOFan(pin, led_pin=led_pin, log=self.log, keep_alive=keep_alive, clock=clock)
                 self.gpio_fan.set_led(self.config["gpio_fan_led"])
             else:
                 self.log.debug(f"Init GPIO Fan with pin: {pin}")
-                self.gpio_fan = GPIOFan(pin, log=self.log)
+                self.gpio_fan = GPIOFan(pin, log=self.log, keep_alive=keep_alive, clock=clock)
             if not self.gpio_fan.is_ready():
                 self.log.warning("GPIO Fan init failed, disable gpio_fan control")
         if 'spc_fan_power' in fans or 'spc_fan' in fans: # spc_fan is deprecated, use spc_fan_power instead
             self.log.debug("Init SPC Fan")
-            self.spc_fan = SPCFan(log=self.log)
+            self.spc_fan = SPCFan(log=self.log, keep_alive=keep_alive, clock=clock)
             if not self.spc_fan.is_ready():
                 self.log.warning("SPC Fan init failed, disable spc_fan control")
         if 'pwm_fan_speed' in fans or 'pwm_fan' in fans: # pwm_fan is deprecated, use pwm_fan_speed instead
             self.log.debug("Init PWM Fan")
-            self.pwm_fan = PWMFan(log=self.log)
+            self.pwm_fan = PWMFan(log=self.log, keep_alive=keep_alive, clock=clock, root=root)
             if not self.pwm_fan.is_ready():
                 self.log.warning("PWM Fan init failed, disable pwm_fan control")
 
         self.level = 0
         self.initial = True
+        self.last_state = None
+        self.throttle = ThrottleDetector(root=root)
+        self.throttle_start = None
         self.__on_state_changed__ = lambda x: None
         self.running = False
         self.thread = None
@@ -122,21 +172,126 @@ class FanService:
             self.config["gpio_fan_led_pin"] = config["gpio_fan_led_pin"]
             if self.gpio_fan.is_ready():
                 self.gpio_fan.change_led_pin(config["gpio_fan_led_pin"])
+        if "fan_keep_alive" in config:
+            self.log.debug(f"Update fan_keep_alive to {config['fan_keep_alive']}")
+            self.config["fan_keep_alive"] = config["fan_keep_alive"]
+            for fan in (self.gpio_fan, self.spc_fan, self.pwm_fan):
+                fan.keep_alive = config["fan_keep_alive"]
+        if has_common_items(CONTROLLER_CONFIG, config.keys()):
+            controller_config = {key: config.get(key, self.config[key]) for key in CONTROLLER_CONFIG}
+            self.log.debug(f"Update fan controller: {controller_config}")
+            controller = self.build_controller(controller_config)
+            self.sensor_controllers = self.build_sensor_controllers(controller_config)
+            self.controller = controller
+            self.config.update(controller_config)
+        if has_common_items(FILTER_CONFIG, config.keys()):
+            window = config.get('fan_filter_window', self.config['fan_filter_window'])
+            alpha = config.get('fan_filter_alpha', self.config['fan_filter_alpha'])
+            self.log.debug(f"Update temperature filter window to {window}, alpha to {alpha}")
+            self.filter = TemperatureFilter(window, alpha)
+            self.config['fan_filter_window'] = window
+            self.config['fan_filter_alpha'] = alpha
+        if "fan_predict_seconds" in config:
+            self.log.debug(f"Update fan_predict_seconds to {config['fan_predict_seconds']}")
+            self.config["fan_predict_seconds"] = config["fan_predict_seconds"]
+
+    def build_controller(self, config):
+        '''Build a fan controller, curves are compiled here, not on every run'''
+        controller = FanController(FAN_LEVELS,
+            mode=config['fan_control_mode'],
+            curve=config['fan_curve'],
+            hysteresis=config['fan_hysteresis'],
+            min_dwell=config['fan_min_dwell'],
+            pid=config['fan_pid'],
+            clock=self.clock)
+        if self.controller is not None:
+            # Carry on from the current output
+            controller.level = self.controller.level
+            controller.duty = self.controller.duty
+        return controller
+
+    def build_sensor_controllers(self, config):
+        '''Build a curve controller for every sensor with a curve, by name or else by kind'''
+        curves = config['fan_sensor_curves']
+        controllers = {}
+        for sensor in self.sensors.sensors:
+            curve = curves.get(sensor.name, curves.get(sensor.kind))
+            if curve is None:
+                continue
+            controller = FanController(FAN_LEVELS,
+                mode=CONTROL_CURVE,
+                curve=curve,
+                hysteresis=config['fan_hysteresis'],
+                min_dwell=config['fan_min_dwell'],
+                clock=self.clock)
+            old = self.sensor_controllers.get(sensor.name)
+            if old is not None:
+                controller.level = old.level
+                controller.duty = old.duty
+            controllers[sensor.name] = controller
+        return controllers
+
+    def sensor_demand(self):
+        '''Highest duty the other temperature sensors ask for, 0 if none'''
+        power = 0
+        if len(self.sensor_controllers) == 0:
+            return power
+        temperatures = self.sensors.read(self.sensor_controllers)
+        for name, sensor_temperature in temperatures.items():
+            _, duty = self.sensor_controllers[name].update(sensor_temperature)
+            if duty > power:
+                self.log.debug("%s temperature %s \"C asks for power %s", name, sensor_temperature, duty)
+                power = duty
+        return power
+
+    @log_error
+    def get_stats(self):
+        return {
+            'gpio_fan': self.gpio_fan.get_stats(),
+            'spc_fan': self.spc_fan.get_stats(),
+            'pwm_fan': self.pwm_fan.get_stats(),
+        }
 
     @log_error
     def get_cpu_temperature(self):
-        file = '/sys/class/thermal/thermal_zone0/temp'
         try:
-            with open(file, 'r') as f:
-                temp = int(f.read())
-            return round(temp/1000, 2)
+            return self.sampler.get('cpu_temperature')
         except Exception as e:
             self.log.error(f'get_cpu_temperature error: {e}')
             return 0.0
 
+    def check_throttle(self):
+        '''Return the current throttle reasons, logging when throttling starts and ends'''
+        if not self.throttle.is_available():
+            return []
+        try:
+            busy = self.sampler.get('cpu_percent') >= THROTTLE_BUSY_PERCENT
+        except Exception:
+            busy = False
+        try:
+            reasons = self.throttle.read(busy=busy)
+        except Exception as e:
+            self.log.error(f'read throttle state error: {e}')
+            return []
+        now = self.clock()
+        if len(reasons) > 0 and self.throttle_start is None:
+            self.throttle_start = now
+            self.log.warning(f"CPU throttling detected: {', '.join(reasons)}")
+        elif len(reasons) == 0 and self.throttle_start is not None:
+            self.log.warning(f"CPU throttling ended after {now - self.throttle_start:.1f}s")
+            self.throttle_start = None
+        return reasons
+
     @log_error
     def run(self):
         state = {}
+        throttle_reasons = self.check_throttle()
+        temperature = self.get_cpu_temperature()
+        filtered = self.filter.add(self.clock(), temperature)
+        slope = self.filter.slope()
+        boost = len(throttle_reasons) > 0 and not has_common_items(throttle_reasons, THROTTLE_NO_BOOST)
+        state['cpu_temperature_filtered'] = round(filtered, 1)
+        state['cpu_temperature_slope'] = round(slope, 2)
         if self.pwm_fan.is_ready() and self.pwm_fan.is_supported():
             if self.initial:
                 self.log.info("PWM Fan is supported, sync all other fan with pwm fan")
@@ -145,30 +300,46 @@ class FanService:
             pwm_fan_speed = self.pwm_fan.get_speed()
             state["pwm_fan_speed"] = pwm_fan_speed
             pwm_fan_level = self.pwm_fan.get_state()
+            # The kernel only follows the CPU temperature, the other fans
+            # follow it but run faster if another sensor asks for more, or
+            # at full speed while throttled
+            level = pwm_fan_level
+            power = FAN_LEVELS[pwm_fan_level]['percent']
+            sensor_power = self.sensor_demand()
+            if boost:
+                level = len(FAN_LEVELS) - 1
+                power = FAN_LEVELS[level]['percent']
+            elif sensor_power > power:
+                power = sensor_power
+                level = self.controller.level_of(power)
             if self.spc_fan.is_ready():
-                spc_fan_power = FAN_LEVELS[pwm_fan_level]['percent']
-                self.spc_fan.set_power(spc_fan_power)
-                state["spc_fan_power"] = spc_fan_power
+                self.spc_fan.set_power(power)
+                state["spc_fan_power"] = power
             if self.gpio_fan.is_ready():
-                gpio_fan_state = pwm_fan_level >= self.config['gpio_fan_mode']
+                gpio_fan_state = level >= self.config['gpio_fan_mode']
                 state["gpio_fan_state"] = gpio_fan_state
                 self.gpio_fan.set(gpio_fan_state)
         else:
-            temperature = self.get_cpu_temperature()
-            self.log.debug(f"cpu temperature: {temperature} \"C")
-            changed = False
-            direction = ""
-            if temperature < FAN_LEVELS[self.level]["low"]:
-                self.level -= 1
-                changed = True
-                direction = "low"
-            elif temperature > FAN_LEVELS[self.level]["high"]:
-                self.level += 1
-                changed = True
-                direction = "high"
-            
-            self.level = max(0, min(self.level, len(FAN_LEVELS) - 1))
-            power = FAN_LEVELS[self.level]['percent']
+            # Every second, leave the formatting to logging in case debug is off
+            self.log.debug("cpu temperature: %s \"C, filtered: %.1f \"C, slope: %.2f \"C/s", temperature, filtered, slope)
+            target = filtered
+            predict_seconds = self.config['fan_predict_seconds']
+            if predict_seconds > 0:
+                # Only ever speed up ahead of time, never slow down
+                predicted = filtered + slope * predict_seconds
+                if predicted > target:
+                    self.log.debug("predicted temperature in %ss: %.1f \"C", predict_seconds, predicted)
+                    target = predicted
+            level, power = self.controller.update(target)
+            # Fan demand is the highest of all sensors
+            sensor_power = self.sensor_demand()
+            if sensor_power > power:
+                power = sensor_power
+                level = self.controller.level_of(power)
+            if boost:
+                level, power = self.controller.boost()
+            changed = level != self.level
+            self.level = level
 
             if self.gpio_fan.is_ready():
                 gpio_fan_state = self.level >= self.config['gpio_fan_mode']
@@ -184,13 +355,15 @@ class FanService:
             if changed:
                 self.log.info(f"set fan level: {FAN_LEVELS[self.level]['name']}")
                 self.log.info(f"set fan power: {power}")
-                self.log.info(
-                    f"cpu temperature: {temperature} \"C, {direction}er than {FAN_LEVELS[self.level][direction]}")
+                self.log.info(f"cpu temperature: {temperature} \"C")
             elif self.initial:
                 self.log.info(f"cpu temperature: {temperature} \"C")
                 self.initial = False
-        
-        self.__on_state_changed__(state)
+
+        tracked = {key: value for key, value in state.items() if key not in STATE_UNTRACKED}
+        if tracked != self.last_state:
+            self.last_state = tracked
+            self.__on_state_changed__(state)
 
     @log_error
     def loop(self):
@@ -243,13 +416,52 @@ def check_ready(func):
     return wrapper
 
 class Fan():
-    def __init__(self, log=None):
+    '''
+    Base of all fans. Writes to the hardware go through _actuate(), which
+    remembers the last value written per channel and skips writing it
+    again, unless keep_alive seconds passed since, to restore it in case
+    something else changed it. keep_alive None never resends.
+    '''
+    def __init__(self, log=None, keep_alive=None, clock=time.monotonic):
         self.log = log
         self._is_ready = False
+        self.keep_alive = keep_alive
+        self.clock = clock
+        # channel: (value, write time)
+        self._committed = {}
+        self.writes = 0
+        self.suppressed = 0
 
     def is_ready(self):
         return self._is_ready
-    
+
+    def _actuate(self, channel, value, write):
+        '''Call write(value) unless redundant, return True if written'''
+        now = self.clock()
+        last = self._committed.get(channel)
+        if last is not None and last[0] == value:
+            if self.keep_alive is None or now - last[1] < self.keep_alive:
+                self.suppressed += 1
+                return False
+        write(value)
+        self._committed[channel] = (value, now)
+        self.writes += 1
+        return True
+
+    def invalidate(self, channel=None):
+        '''Forget the values written, so the next writes go through'''
+        if channel is None:
+            self._committed.clear()
+        else:
+            self._committed.pop(channel, None)
+
+    def get_stats(self):
+        return {
+            'writes': self.writes,
+            'suppressed': self.suppressed,
+        }
+
+
     # Decorator to check if the fan is ready
 class GPIOFan(Fan):
     def __init__(self, pin, *args, led_pin=None, **kwargs):
@@ -271,6 +483,7 @@ class GPIOFan(Fan):
 
     def change_pin(self, pin):
         self.fan.close()
+        self.invalidate('fan')
         self.pin = pin
         try:
             import gpiozero
@@ -282,11 +495,12 @@ class GPIOFan(Fan):
 
     def change_led_pin(self, led_pin):
         self.led.close()
+        self.invalidate('led')
         self.led_pin = led_pin
         try:
             import gpiozero
             self.led = gpiozero.DigitalOutputDevice(led_pin)
-            self.led.off()
+            self._actuate('led', 0, self._write_led)
             self._is_ready = True
         except Exception as e:
             self.log.error(f"Change led pin error: {e}")
@@ -295,9 +509,15 @@ class GPIOFan(Fan):
     @log_error
     @check_ready
     def set(self, value: bool):
-        self.fan.value = value
+        self._actuate('fan', value, self._write_fan)
         if self.led_follow:
-            self.led.value = value
+            self._actuate('led', value, self._write_led)
+
+    def _write_fan(self, value):
+        self.fan.value = value
+
+    def _write_led(self, value):
+        self.led.value = value
 
     @log_error
     @check_ready
@@ -308,9 +528,9 @@ class GPIOFan(Fan):
         else:
             self.led_follow = False
             if value == 'on':
-                self.led.value = 1
+                self._actuate('led', 1, self._write_led)
             elif value == 'off':
-                self.led.value = 0
+                self._actuate('led', 0, self._write_led)
             else:
                 self.log.warning(f"Invalid led value: {value}")
 
@@ -364,7 +584,7 @@ class SPCFan(Fan):
             raise ValueError("Invalid power")
         
         power = max(0, min(100, power))
-        self.spc.set_fan_power(power)
+        self._actuate('power', power, self.spc.set_fan_power)
         return power
 
     @log_error
@@ -387,29 +607,45 @@ class PWMFan(Fan):
     ]
 
     @log_error
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, root=ROOT, **kwargs):
         super().__init__(*args, **kwargs)
-        if not PWMFan.pwm_fan_supported():
+        self.root = root
+        self.state_file = None
+        self.state_writer = None
+        self.speed = None
+        if not PWMFan.pwm_fan_supported(root):
             self.log.warning("PWM Fan is not supported")
             self._is_ready = False
             return
 
         # Check if system support pwm fan control
-        _, os_id = run_command("lsb_release -a |grep ID | awk -F ':' '{print $2}'")
-        os_id = os_id.strip()
-        _, os_code_name = run_command("lsb_release -a |grep Codename | awk -F ':' '{print $2}'")
-        os_code_name = os_code_name.strip()
+        os_release = get_os_release()
+        os_id = os_release.get('ID', '')
+        os_code_name = os_release.get('VERSION_CODENAME', '')
 
         self.enable_control = False
         if os_id.lower() in self.TEMP_CONTROL_INTERVENE_OS or os_code_name.lower() in self.TEMP_CONTROL_INTERVENE_OS:
             self.log.warning("System do not support pwm fan control")
             self.enable_control = True
+            self.open_state_writer()
         self._is_ready = True
 
+    def open_state_writer(self):
+        '''
+        Open cur_state for writing. Without permission, fall back to sudo and
+        report it once here rather than on every write.
+        '''
+        path = root_path(self.root, COOLING_DEVICE_STATE.format(device=0))
+        try:
+            self.state_writer = SysfsWriter(path)
+        except PermissionError:
+            self.log.warning(f"No permission to write {path}, fall back to sudo. "
+                "Install udev/99-pm-auto-fan.rules to allow it, see README")
+
     @staticmethod
-    def pwm_fan_supported():
+    def pwm_fan_supported(root=ROOT):
         from os import path
-        return path.exists('/sys/class/thermal/cooling_device0/cur_state') and path.exists('/sys/devices/platform/cooling_fan')
+        return path.exists(root_path(root, COOLING_DEVICE_STATE.format(device=0))) and path.exists(root_path(root, COOLING_FAN))
 
     @log_error
     @check_ready
@@ -419,11 +655,11 @@ class PWMFan(Fan):
     @log_error
     @check_ready
     def get_state(self):
-        path = '/sys/class/thermal/cooling_device0/cur_state'
         try:
-            with open(path, 'r') as f:
-                cur_state = int(f.read())
-            return cur_state
+            if self.state_file is None:
+                path = root_path(self.root, COOLING_DEVICE_STATE.format(device=0))
+                self.state_file = SysfsFile(path, size=16)
+            return self.state_file.read_int()
         except Exception as e:
             self.log.error(f'read pwm fan state error: {e}')
             return 0
@@ -440,10 +676,16 @@ class PWMFan(Fan):
             elif level < 0:
                 level = 0
 
-            cmd = f"echo '{level}' | sudo tee -a /sys/class/thermal/cooling_device0/cur_state"
-            result = subprocess.check_output(cmd, shell=True)
+            self._actuate('state', level, self._write_state)
+            return level
 
-            return result
+    def _write_state(self, level):
+        if self.state_writer is not None:
+            self.state_writer.write(level, force=True)
+            return
+        path = root_path(self.root, COOLING_DEVICE_STATE.format(device=0))
+        cmd = f"echo '{level}' | sudo tee -a {path}"
+        subprocess.check_output(cmd, shell=True)
 
     @log_error
     @check_ready
@@ -451,15 +693,10 @@ class PWMFan(Fan):
         '''
         path =  '/sys/devices/platform/cooling_fan/hwmon/*/fan1_input'
         '''
-        dir = '/sys/devices/platform/cooling_fan/hwmon/'
-        secondary_dir = os.listdir(dir)
-        path = f'{dir}/{secondary_dir[0]}/fan1_input'
-
-        os.listdir
         try:
-            with open(path, 'r') as f:
-                speed = int(f.read())
-            return speed
+            if self.speed is None:
+                self.speed = FanSpeed(root=self.root)
+            return self.speed.read()
         except Exception as e:
             self.log.error(f'read fan1 speed error: {e}')
             return 0
@@ -475,4 +712,10 @@ class PWMFan(Fan):
     def close(self):
         self.off()
         self._is_ready = False
+        if self.state_file is not None:
+            self.state_file.close()
+        if self.state_writer is not None:
+            self.state_writer.close()
+        if self.speed is not None and self.speed.file is not None:
+            self.speed.file.close()
         self.log.debug("PWM Fan closed")
\ No newline at end of file
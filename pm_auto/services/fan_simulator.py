@@ -0,0 +1,327 @@
+# Fan simulator
+#
+# Replay a temperature/load trace through FanService.run() with a simulated
+# clock and fake fans, to compare controller modes and tune curves without
+# a Raspberry Pi heating up.
+#
+# A trace is a CSV file with a header and the columns:
+#
+#     time         seconds since the start
+#     temperature  CPU temperature in Celsius, optional
+#     load         CPU load 0 ~ 100, optional
+#
+# With a temperature the trace is replayed as is, the fan can't change it.
+# Without one, the temperature follows a first order thermal model driven by
+# the load and cooled by the fan, so the controller sees the result of its
+# own decisions. Traces can also be stored in a compact binary format, see
+# write_binary_trace().
+#
+#     python3 -m pm_auto.services.fan_simulator trace.csv --mode curve --mode pid
+#
+import csv
+import json
+import logging
+import math
+import struct
+import tempfile
+
+from .fan_service import FanService, GPIOFan, SPCFan, PWMFan, Fan, FAN_LEVELS
+
+TRACE_MAGIC = b'PMFT'
+TRACE_HEADER = struct.Struct('<4sI')
+# time, temperature, load, NaN when missing
+TRACE_SAMPLE = struct.Struct('<fff')
+
+THRESHOLD = 70
+INTERVAL = 1
+
+# Thermal model
+AMBIENT = 25
+LOAD_RISE = 60 # Celsius above ambient at full load without fan
+FAN_COOLING = 0.5 # Fraction of the rise removed at full fan duty
+TIME_CONSTANT = 30 # seconds
+FAN_MAX_RPM = 8000
+
+def read_trace(path):
+    '''List of (time, temperature, load) samples, None for missing values'''
+    with open(path, 'rb') as f:
+        magic = f.read(len(TRACE_MAGIC))
+    if magic == TRACE_MAGIC:
+        return read_binary_trace(path)
+    samples = []
+    with open(path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            temperature = row.get('temperature')
+            load = row.get('load')
+            samples.append((
+                float(row['time']),
+                float(temperature) if temperature not in (None, '') else None,
+                float(load) if load not in (None, '') else None,
+            ))
+    return samples
+
+def read_binary_trace(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, count = TRACE_HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC:
+        raise ValueError(f"Not a fan trace: {path}")
+    samples = []
+    for t, temperature, load in TRACE_SAMPLE.iter_unpack(data[TRACE_HEADER.size:TRACE_HEADER.size + count * TRACE_SAMPLE.size]):
+        samples.append((
+            t,
+            None if math.isnan(temperature) else temperature,
+            None if math.isnan(load) else load,
+        ))
+    return samples
+
+def write_binary_trace(path, samples):
+    '''Write (time, temperature, load) samples, 12 bytes each'''
+    nan = float('nan')
+    with open(path, 'wb') as f:
+        f.write(TRACE_HEADER.pack(TRACE_MAGIC, len(samples)))
+        for t, temperature, load in samples:
+            f.write(TRACE_SAMPLE.pack(
+                t,
+                nan if temperature is None else temperature,
+                nan if load is None else load))
+
+class SimClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class SimOutput():
+    '''Stands in for a gpiozero DigitalOutputDevice'''
+    def __init__(self):
+        self.value = 0
+
+    def close(self):
+        pass
+
+class SimGPIOFan(GPIOFan):
+    def __init__(self, *args, **kwargs):
+        Fan.__init__(self, *args, **kwargs)
+        self.pin = None
+        self.fan = SimOutput()
+        self.led = None
+        self.led_follow = False
+        self._is_ready = True
+
+    def duty(self):
+        return 100 if self.fan.value else 0
+
+class SimSPC():
+    def __init__(self):
+        self.power = 0
+
+    def set_fan_power(self, power):
+        self.power = power
+
+    def get_fan_power(self):
+        return self.power
+
+class SimSPCFan(SPCFan):
+    def __init__(self, *args, **kwargs):
+        Fan.__init__(self, *args, **kwargs)
+        self.spc = SimSPC()
+        self._is_ready = True
+
+    def duty(self):
+        return self.spc.power
+
+class SimStateWriter():
+    def __init__(self):
+        self.value = 0
+
+    def write(self, value, force=False):
+        self.value = int(value)
+        return True
+
+    def close(self):
+        pass
+
+class SimPWMFan(PWMFan):
+    '''A PWM fan left to pm_auto, like on systems in TEMP_CONTROL_INTERVENE_OS'''
+    def __init__(self, *args, **kwargs):
+        Fan.__init__(self, *args, **kwargs)
+        self.state_file = None
+        self.speed = None
+        self.state_writer = SimStateWriter()
+        self.enable_control = True
+        self._is_ready = True
+
+    def get_state(self):
+        return self.state_writer.value
+
+    def get_speed(self):
+        return FAN_MAX_RPM * self.duty() // 100
+
+    def duty(self):
+        return FAN_LEVELS[self.state_writer.value]['percent']
+
+class Simulation():
+    '''
+    Run FanService over a trace.
+
+    config: FanService config, like fan_control_mode and fan_curve
+    fans: simulated fans, any of 'gpio_fan_state', 'spc_fan_power', 'pwm_fan_speed'
+    threshold: temperature counted as too hot in the report
+    interval: seconds between FanService.run() calls
+    '''
+    def __init__(self, config={}, fans=['gpio_fan_state', 'spc_fan_power', 'pwm_fan_speed'],
+            threshold=THRESHOLD, interval=INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.clock = SimClock()
+        self.temperature = AMBIENT
+        log = logging.getLogger(__name__)
+        # An empty sysfs tree, the simulation must not see the real one
+        self._root = tempfile.TemporaryDirectory()
+        self.service = FanService(config, fans=[], get_logger=lambda name: log,
+            root=self._root.name, clock=self.clock)
+        keep_alive = self.service.config['fan_keep_alive']
+        kwargs = {'log': log, 'keep_alive': keep_alive, 'clock': self.clock}
+        if 'gpio_fan_state' in fans:
+            self.service.gpio_fan = SimGPIOFan(**kwargs)
+        if 'spc_fan_power' in fans:
+            self.service.spc_fan = SimSPCFan(**kwargs)
+        if 'pwm_fan_speed' in fans:
+            self.service.pwm_fan = SimPWMFan(**kwargs)
+        self.service.get_cpu_temperature = lambda: self.temperature
+
+        self.fans = [fan for fan in (self.service.gpio_fan, self.service.spc_fan, self.service.pwm_fan)
+            if fan.is_ready()]
+
+    def duty(self):
+        '''Highest duty of all simulated fans'''
+        duty = 0
+        for fan in self.fans:
+            fan_duty = fan.duty()
+            if fan_duty > duty:
+                duty = fan_duty
+        return duty
+
+    def run(self, samples):
+        '''Replay samples, return a report dict'''
+        if len(samples) == 0:
+            raise ValueError("Empty trace")
+        service = self.service
+        clock = self.clock
+        interval = self.interval
+        threshold = self.threshold
+        over_threshold = 0.0
+        duty_time = 0.0
+        level_changes = 0
+        max_temperature = None
+        level = service.level
+        duty = self.duty()
+        start = samples[0][0]
+        next_run = start
+        clock.now = start
+        load = 0.0
+        modeled = False
+        i = 0
+        count = len(samples)
+        end = samples[-1][0]
+        # Thermal model step, the model moves this fraction towards its
+        # target every interval
+        step = 1 - math.exp(-interval / TIME_CONSTANT)
+        first = True
+        while clock.now <= end:
+            # Latest sample at or before now
+            while i < count and samples[i][0] <= clock.now:
+                _, temperature, sample_load = samples[i]
+                if sample_load is not None:
+                    load = sample_load
+                modeled = temperature is None
+                if not modeled:
+                    self.temperature = temperature
+                i += 1
+            if modeled and not first:
+                # No recorded temperature, follow the thermal model
+                target = AMBIENT + LOAD_RISE * load / 100 * (1 - FAN_COOLING * duty / 100)
+                self.temperature += (target - self.temperature) * step
+            first = False
+
+            service.run()
+            duty = self.duty()
+            if service.level != level:
+                level = service.level
+                level_changes += 1
+            if self.temperature > threshold:
+                over_threshold += interval
+            if max_temperature is None or self.temperature > max_temperature:
+                max_temperature = self.temperature
+            duty_time += duty * interval
+            next_run += interval
+            clock.now = next_run
+
+        duration = end - start + interval
+        writes = 0
+        suppressed = 0
+        for fan in (service.gpio_fan, service.spc_fan, service.pwm_fan):
+            writes += fan.writes
+            suppressed += fan.suppressed
+        return {
+            'mode': service.config['fan_control_mode'],
+            'duration': duration,
+            'time_over_threshold': over_threshold,
+            'max_temperature': round(max_temperature, 2),
+            'writes': writes,
+            'suppressed': suppressed,
+            'level_changes': level_changes,
+            'mean_duty': round(duty_time / duration, 2),
+        }
+
+def simulate(samples, config={}, **kwargs):
+    '''Run one simulation, return its report'''
+    return Simulation(config, **kwargs).run(samples)
+
+def _simulate_timed(args):
+    import time
+    samples, config, kwargs = args
+    start = time.perf_counter()
+    report = simulate(samples, config, **kwargs)
+    report['wall_time'] = round(time.perf_counter() - start, 3)
+    return report
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Replay a temperature/load trace through the fan controller')
+    parser.add_argument('trace', help='CSV or binary trace file')
+    parser.add_argument('--mode', action='append', help='Fan control mode, repeat to compare modes')
+    parser.add_argument('--config', help='JSON file with FanService config, like fan_curve')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='Temperature counted as too hot')
+    parser.add_argument('--to-binary', metavar='PATH', help='Convert the trace to the binary format and exit')
+    args = parser.parse_args()
+
+    samples = read_trace(args.trace)
+    if args.to_binary:
+        write_binary_trace(args.to_binary, samples)
+        print(f'{len(samples)} samples written to {args.to_binary}')
+        return
+    config = {}
+    if args.config:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+    modes = args.mode or [config.get('fan_control_mode', 'step')]
+    jobs = []
+    for mode in modes:
+        mode_config = dict(config)
+        mode_config['fan_control_mode'] = mode
+        jobs.append((samples, mode_config, {'threshold': args.threshold}))
+    if len(jobs) == 1:
+        for report in map(_simulate_timed, jobs):
+            print(json.dumps(report))
+        return
+    # Modes are independent, compare them on all cores
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor() as executor:
+        for report in executor.map(_simulate_timed, jobs):
+            print(json.dumps(report))
+
+if __name__ == '__main__':
+    main()
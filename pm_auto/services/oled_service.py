@@ -1,11 +1,7 @@
 from pm_auto.services.pironman_mcu_service import INTERVAL
 from ..libs.ssd1306 import SSD1306, Rect
-from sf_rpi_status import \
-    get_cpu_temperature, \
-    get_cpu_percent, \
-    get_memory_info, \
-    get_disks_info, \
-    get_ips
+from ..libs.frame_pipeline import FramePipeline
+from ..libs.metrics import get_sampler
 from ..libs.i2c import I2C
 from ..libs.utils import format_bytes, log_error
 
@@ -14,6 +10,8 @@ import threading
 from enum import Enum
 
 INTERVAL = 1
+# Turn the panel off after showing the power off screen this long
+POWER_OFF_TIMEOUT = 30
 
 OLED_DEFAULT_CONFIG = {
     'temperature_unit': 'C',
@@ -27,6 +25,7 @@ OLED_DEFAULT_CONFIG = {
 class OLEDPage(Enum):
     POWER_OFF = 0
     ALL_INFO = 1
+    OFF = 2  # Power off screen done, panel turned off
 
 class OLEDService():
     @log_error
@@ -36,6 +35,8 @@ class OLEDService():
             get_logger = logging.getLogger
         self.log = get_logger(__name__)
         self._is_ready = False
+        self.oled = None
+        self.pipeline = None
 
         try:
             self.oled = SSD1306()
@@ -43,6 +44,8 @@ class OLEDService():
             self.log.error(f"Failed to initialize OLED service: {e}")
             return
         self._is_ready = self.oled.is_ready()
+        self.pipeline = FramePipeline(self.oled, log=self.log)
+        self.oled.set_pipeline(self.pipeline)
 
         self.temperature_unit = OLED_DEFAULT_CONFIG['temperature_unit']
         self.disk_mode = OLED_DEFAULT_CONFIG['oled_disk']
@@ -60,6 +63,9 @@ class OLEDService():
         self.running = False
         self.thread = None
         self.current_page = OLEDPage.ALL_INFO
+        # Signaled on button, wake, sleep and config changes
+        self._condition = threading.Condition()
+        self._changed = False
         
         self.update_config(config)
 
@@ -93,6 +99,7 @@ class OLEDService():
                 self.wake()
             else:
                 self.sleep()
+        self._notify()
 
     @log_error
     def set_rotation(self, rotation):
@@ -102,21 +109,28 @@ class OLEDService():
     def is_ready(self):
         return self._is_ready
 
+    @log_error
+    def get_stats(self):
+        stats = self.pipeline.get_stats()
+        stats.update(self.oled.get_stats())
+        return stats
+
     @log_error
     def get_data(self):
-        memory_info = get_memory_info()
-        ips = get_ips()
+        metrics = get_sampler().snapshot()
+        memory_info = metrics.memory
+        ips = metrics.ips
 
         data = {
-            'cpu_temperature': get_cpu_temperature(),
-            'cpu_percent': get_cpu_percent(),
+            'cpu_temperature': metrics.cpu_temperature,
+            'cpu_percent': metrics.cpu_percent,
             'memory_total': memory_info.total,
             'memory_used': memory_info.used,
             'memory_percent': memory_info.percent,
             'ips': []
         }
         # Get disk info
-        disks_info = get_disks_info()
+        disks_info = metrics.disks
         data['disk_total'] = 0
         data['disk_used'] = 0
         data['disk_percent'] = 0
@@ -232,19 +246,33 @@ class OLEDService():
         self.current_page = OLEDPage.POWER_OFF
         self.wake()
 
+    def _notify(self):
+        '''Wake up the loop to handle a state change'''
+        with self._condition:
+            self._changed = True
+            self._condition.notify()
+
     @log_error
     def wake(self):
         self.wake_start_time = time.time()
         self.wake_flag = True
+        self._notify()
 
     def set_button(self, button_state):
-        self.button = button_state
+        # Button services report released on every poll, nothing to handle
+        if not button_state or button_state == 'released':
+            return
+        # Set under the condition, the loop reads and clears it there
+        with self._condition:
+            self.button = button_state
+            self._changed = True
+            self._condition.notify()
 
     @log_error
     def sleep(self):
+        # The loop clears the screen once it sees the flag
         self.wake_flag = False
-        self.oled.clear()
-        self.oled.display()
+        self._notify()
 
     @log_error
     def loop(self):
@@ -261,14 +289,37 @@ class OLEDService():
         page_index = 0
         last_page_index = -1
         last_refresh_time = 0
+        blank = False
+        power_off_deadline = None
 
         if self.oled is None or not self.oled.is_ready():
             self.log.error("OLED service not ready")
             return
 
         while self.running:
+            with self._condition:
+                self._changed = False
+                button = self.button
+                self.button = False
+
+            if self.current_page == OLEDPage.POWER_OFF:
+                # Render once, then wait for the button or the timeout
+                if power_off_deadline is None:
+                    self.draw_power_off()
+                    power_off_deadline = time.time() + POWER_OFF_TIMEOUT
+                if button == 'long_press_2s_released' or time.time() >= power_off_deadline:
+                    self.log.info("Power off screen done, turning OLED off")
+                    self.current_page = OLEDPage.OFF
+                    power_off_deadline = None
+                    self.oled.off()
+                    continue
+                self._wait(power_off_deadline - time.time())
+                continue
+            elif self.current_page == OLEDPage.OFF:
+                self._wait(None)
+                continue
 
-            if self.button == 'single_click':
+            if button == 'single_click':
                 if not self.wake_flag:
                     self.log.info("OLED service waking up")
                     self.wake_flag = True
@@ -277,36 +328,45 @@ class OLEDService():
                     page_index += 1
                     if page_index >= len(page):
                         page_index = 0
-                self.button = False
                 self.wake_start_time = time.time()
-            elif self.button == 'double_click':
+            elif button == 'double_click':
                 if self.wake_flag:
                     page_index -= 1
                     if page_index < 0:
                         page_index = len(page) - 1
                     self.wake_start_time = time.time()
-                    
+
             if self.wake_flag:
-                if last_page_index != page_index or time.time() - last_refresh_time > INTERVAL:
+                if self.sleep_timeout > 0 and time.time() - self.wake_start_time > self.sleep_timeout:
+                    self.log.info("OLED sleep timeout, sleeping")
+                    self.wake_flag = False
+                elif last_page_index != page_index or time.time() - last_refresh_time >= INTERVAL:
                     last_page_index = page_index
                     last_refresh_time = time.time()
                     page[page_index](self.oled)
+                    blank = False
 
-                if self.sleep_timeout > 0 and time.time() - self.wake_start_time > self.sleep_timeout:
-                    self.log.info("OLED sleep timeout, sleeping")
-                    self.sleep()
-                    continue
-
+            if not self.wake_flag and not blank:
+                self.oled.clear()
+                self.oled.display()
+                blank = True
+                last_page_index = -1
 
-            if self.current_page == OLEDPage.POWER_OFF:
-                self.draw_power_off()
-
-                while True:
-                    if self.button == 'long_press_2s_released':
-                        self.wake_flag = False
-                        self.sleep()
-
-            time.sleep(.05)
+            # Sleep until the next refresh or sleep timeout is due, or forever
+            # while the screen is off, unless something changes meanwhile.
+            timeout = None
+            if self.wake_flag:
+                timeout = last_refresh_time + INTERVAL - time.time()
+                if self.sleep_timeout > 0:
+                    timeout = min(timeout, self.wake_start_time + self.sleep_timeout - time.time())
+                timeout = max(timeout, 0)
+            self._wait(timeout)
+
+    def _wait(self, timeout):
+        '''Wait for a state change, at most timeout seconds, None for no limit'''
+        with self._condition:
+            if self.running and not self._changed:
+                self._condition.wait(timeout)
 
     @log_error
     def start(self):
@@ -314,14 +374,19 @@ class OLEDService():
             self.log.warning("OLED service already running")
             return
         self.running = True
+        self.wake_start_time = time.time()
+        self.pipeline.start()
         self.thread = threading.Thread(target=self.loop, daemon=True)
         self.thread.start()
 
     @log_error
     def stop(self):
         self.running = False
+        self._notify()
         if self.thread is not None:
             self.thread.join()
+        if self.pipeline is not None:
+            self.pipeline.stop()
         if self.oled is not None and self.oled.is_ready():
             self.oled.clear()
             self.oled.display()
@@ -3,6 +3,13 @@
 # This is a service for Pironman MCU. Some model of Pironman have a build in MCU onboard to control the hardware.
 # This service is used to control the hardware of Pironman MCU.
 #
+# Button and shutdown events are rare, so the MCU isn't polled at a fixed
+# rate. With pironman_mcu_interrupt_pin set, the service sleeps until the
+# MCU pulls its interrupt line, with a slow safety poll in case an edge is
+# missed. Without it, polling is adaptive: fast for ACTIVE_TIME seconds
+# after an event, then backing off to the idle interval. The MCU latches
+# events in its registers, so a slow poll delays an event but never loses it.
+#
 import threading
 import time
 from enum import IntEnum
@@ -11,7 +18,14 @@ from ..libs.utils import log_error
 from ..libs.pironman_mcu import PironmanMCU, ShutdownReason
 from sf_rpi_status import shutdown
 
+# Fast poll interval, right after an event
 INTERVAL = 0.1
+# Longest poll interval when idle, pironman_mcu_idle_interval
+IDLE_INTERVAL = 1.0
+# Seconds of fast polling after an event, for click sequences and long presses
+ACTIVE_TIME = 5
+# Safety poll interval in interrupt mode
+INTERRUPT_INTERVAL = 10
 
 class PironmanMCUService:
     def __init__(self, config, get_logger=None):
@@ -30,6 +44,16 @@ class PironmanMCUService:
         self.__on_shutdown__ = lambda reason: None
         self.running = False
         self.thread = None
+        # Set by the interrupt line or stop() to end a wait early
+        self.wakeup = threading.Event()
+        self.interrupt = None
+        self.interrupt_pin = None
+        self.interrupt_pull_up = True
+        self.idle_interval = IDLE_INTERVAL
+        self.interval = INTERVAL
+        self.last_activity = None
+        self.polls = 0
+        self.update_config(config)
     
     @log_error
     def set_debug_level(self, level):
@@ -41,8 +65,65 @@ class PironmanMCUService:
 
     @log_error
     def update_config(self, config):
-        # No config to update for now
-        pass
+        updated = False
+        if 'pironman_mcu_interrupt_pin' in config and config['pironman_mcu_interrupt_pin'] != self.interrupt_pin:
+            self.interrupt_pin = config['pironman_mcu_interrupt_pin']
+            updated = True
+        if 'pironman_mcu_interrupt_pull_up' in config and config['pironman_mcu_interrupt_pull_up'] != self.interrupt_pull_up:
+            self.interrupt_pull_up = config['pironman_mcu_interrupt_pull_up']
+            updated = True
+        if 'pironman_mcu_idle_interval' in config:
+            self.idle_interval = max(INTERVAL, config['pironman_mcu_idle_interval'])
+        if updated:
+            self.init_interrupt()
+
+    @log_error
+    def init_interrupt(self):
+        '''
+        Watch the interrupt pin, fall back to polling if it can't be used.
+        The loop thread may be using the old device, it only ever reads
+        self.interrupt once per poll and copes with it being closed.
+        '''
+        old = self.interrupt
+        self.interrupt = None
+        if old is not None:
+            old.close()
+        if self.interrupt_pin is None:
+            return False
+        try:
+            import gpiozero
+            interrupt = gpiozero.DigitalInputDevice(self.interrupt_pin, pull_up=self.interrupt_pull_up)
+        except Exception as e:
+            self.log.warning(f"Failed to watch MCU interrupt on pin {self.interrupt_pin}, polling instead: {e}")
+            return False
+        interrupt.when_activated = self.wakeup.set
+        self.interrupt = interrupt
+        self.log.info(f"Watching MCU interrupt on pin {self.interrupt_pin}")
+        # Look at the registers now, the line may already be active
+        self.wakeup.set()
+        return True
+
+    def next_interval(self, active, now):
+        '''Seconds until the next poll, active if the last poll found an event'''
+        # Read once, update_config() may replace it from another thread
+        interrupt = self.interrupt
+        if interrupt is not None:
+            try:
+                # The line stays active until the events are cleared
+                line_active = interrupt.is_active
+            except Exception:
+                # Closed meanwhile, poll again soon and pick up the new one
+                line_active = True
+            if active or line_active:
+                return INTERVAL
+            return INTERRUPT_INTERVAL
+        if active:
+            self.last_activity = now
+        if self.last_activity is not None and now - self.last_activity < ACTIVE_TIME:
+            self.interval = INTERVAL
+        else:
+            self.interval = min(self.interval * 2, self.idle_interval)
+        return self.interval
 
     @log_error
     def set_on_wakeup(self, on_wakeup):
@@ -57,17 +138,39 @@ class PironmanMCUService:
         if not self._is_ready:
             self.log.error("PironmanMCUService is not ready")
             return
+        errors = 0
         while self.running:
-            wakeup_button = self.mcu.get_button()
-            shutdown_request = self.mcu.get_shutdown_request()
-            if wakeup_button:
-                self.__on_wakeup__(wakeup_button)
-            if shutdown_request != ShutdownReason.NONE:
-                self.log.info(f"Shutdown request {ShutdownReason(shutdown_request).name}")
-                self.__on_shutdown__(shutdown_request)
-                time.sleep(3)
-                shutdown()
-            time.sleep(INTERVAL)
+            # Clear before reading, an edge during the read wakes the next wait
+            self.wakeup.clear()
+            # Keep going on errors, a dead loop would ignore the power button
+            try:
+                active = self.poll()
+                errors = 0
+                interval = self.next_interval(active, time.monotonic())
+            except Exception as e:
+                if errors == 0:
+                    self.log.error(f"Poll MCU error: {e}")
+                errors += 1
+                interval = self.idle_interval
+            self.wakeup.wait(interval)
+
+    def poll(self):
+        '''Read the MCU once and handle its events, return True if there were any'''
+        # One block read instead of a read and write per register
+        snapshot = self.mcu.get_snapshot()
+        self.polls += 1
+        active = False
+        if snapshot.button != 0:
+            active = True
+            self.__on_wakeup__(snapshot.button_name)
+        shutdown_request = snapshot.shutdown_request
+        if shutdown_request != ShutdownReason.NONE:
+            active = True
+            self.log.info(f"Shutdown request {ShutdownReason(shutdown_request).name}")
+            self.__on_shutdown__(shutdown_request)
+            time.sleep(3)
+            shutdown()
+        return active
 
     @log_error
     def start(self):
@@ -82,6 +185,10 @@ class PironmanMCUService:
     def stop(self):
         if self.running:
             self.running = False
+            self.wakeup.set()
             self.thread.join()
+        if self.interrupt is not None:
+            self.interrupt.close()
+            self.interrupt = None
         if self.mcu is not None:
             self.mcu.close()
@@ -0,0 +1,34 @@
+'''
+Temperature filter and fan controller response to a temperature spike.
+
+    python3 -m pytest test/test_fan_controller.py
+'''
+from pm_auto.libs.fan_controller import FanController, TemperatureFilter, CONTROL_STEP
+from pm_auto.services.fan_service import FanService, FAN_LEVELS
+
+def test_filter_follows_rises_and_smooths_falls():
+    filter = TemperatureFilter(size=10, alpha=0.3)
+    assert filter.add(0, 40) == 40
+    assert filter.add(1, 80) == 80
+    assert 40 < filter.add(2, 40) < 80
+
+def test_default_step_response_to_spike():
+    # Same as without any smoothing, one level a second
+    filter = TemperatureFilter()
+    controller = FanController(FAN_LEVELS, mode=CONTROL_STEP)
+    controller.update(filter.add(0, 40))
+    seconds = 0
+    while controller.level < len(FAN_LEVELS) - 1:
+        seconds += 1
+        controller.update(filter.add(seconds, 80))
+    assert seconds == len(FAN_LEVELS) - 1
+
+def test_state_callback_ignores_filter_noise(tmp_path):
+    calls = []
+    service = FanService({}, root=str(tmp_path))
+    service.set_on_state_changed(calls.append)
+    temperatures = iter([40.0, 40.4, 39.8, 40.2])
+    service.get_cpu_temperature = lambda: next(temperatures)
+    for _ in range(4):
+        service.run()
+    assert len(calls) == 1
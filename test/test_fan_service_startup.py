@@ -0,0 +1,42 @@
+'''
+FanService construction must not spawn any process, startup used to run
+lsb_release twice just to detect the OS.
+
+    python3 -m pytest test/test_fan_service_startup.py
+'''
+import os
+import subprocess
+import pytest
+
+from pm_auto.libs import utils
+from pm_auto.services import fan_service
+from pm_auto.services.fan_service import FanService, PWMFan
+
+@pytest.fixture
+def spawned(monkeypatch):
+    spawned = []
+    def spawn(*args, **kwargs):
+        spawned.append(args)
+        raise AssertionError(f"Process spawned: {args}")
+    monkeypatch.setattr(subprocess, 'Popen', spawn)
+    monkeypatch.setattr(os, 'system', spawn)
+    monkeypatch.setattr(os, 'popen', spawn)
+    monkeypatch.setattr(PWMFan, 'pwm_fan_supported', staticmethod(lambda root=fan_service.ROOT: True))
+    utils.get_os_release.cache_clear()
+    return spawned
+
+def test_fan_service_init_spawns_no_process(spawned):
+    service = FanService({}, fans=['pwm_fan_speed'])
+    assert service.pwm_fan.is_ready()
+    assert spawned == []
+
+def test_os_release_parsed_once(spawned, monkeypatch):
+    opened = []
+    real_open = open
+    def counting_open(path, *args, **kwargs):
+        opened.append(path)
+        return real_open(path, *args, **kwargs)
+    monkeypatch.setattr('builtins.open', counting_open)
+    FanService({}, fans=['pwm_fan_speed'])
+    FanService({}, fans=['pwm_fan_speed'])
+    assert len([path for path in opened if 'os-release' in path]) <= 1
@@ -0,0 +1,39 @@
+'''
+Replay synthetic traces through the fan simulator.
+
+    python3 -m pytest test/test_fan_simulator.py
+'''
+from pm_auto.services.fan_simulator import simulate, read_trace, write_binary_trace
+
+# A spike from idle straight to 80 "C for 5 minutes, then back
+SPIKE = [(t, 80.0 if 60 <= t < 360 else 40.0, None) for t in range(600)]
+# Full load for 10 minutes, then idle, temperature from the thermal model
+LOAD = [(t, None, 100.0 if t < 600 else 0.0) for t in range(1200)]
+
+def test_report():
+    report = simulate(SPIKE, {'fan_control_mode': 'step'})
+    assert report['duration'] == 600
+    assert report['time_over_threshold'] == 300
+    assert report['max_temperature'] == 80
+    # 3 fans run every second, most writes are redundant
+    assert report['writes'] + report['suppressed'] == 3 * 600
+    assert report['writes'] < report['suppressed']
+    assert report['level_changes'] > 0
+
+def test_jump_reacts_faster_than_step():
+    # No smoothing, so the controller sees the spike as is
+    step = simulate(SPIKE, {'fan_control_mode': 'step', 'fan_filter_alpha': 1})
+    jump = simulate(SPIKE, {'fan_control_mode': 'jump', 'fan_filter_alpha': 1})
+    assert jump['level_changes'] == 2
+    assert jump['level_changes'] < step['level_changes']
+
+def test_thermal_model_responds_to_fan():
+    cooled = simulate(LOAD, {'fan_control_mode': 'curve'})
+    uncooled = simulate(LOAD, {'fan_control_mode': 'curve'}, fans=[])
+    assert cooled['max_temperature'] < uncooled['max_temperature']
+    assert uncooled['mean_duty'] == 0
+
+def test_binary_trace(tmp_path):
+    path = tmp_path / 'trace.bin'
+    write_binary_trace(path, LOAD)
+    assert read_trace(path) == LOAD
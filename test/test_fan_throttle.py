@@ -0,0 +1,127 @@
+'''
+FanService throttle boost and sensor demand end to end against a fake
+sysfs/procfs tree, from the cpufreq, firmware and hwmon files to the fans.
+
+    python3 -m pytest test/test_fan_throttle.py
+'''
+import os
+import pytest
+
+from pm_auto.services.fan_service import FanService, FAN_LEVELS
+from pm_auto.services.fan_simulator import SimPWMFan, SimSPCFan
+
+CPUFREQ = 'sys/devices/system/cpu/cpu0/cpufreq'
+FIRMWARE = 'sys/devices/platform/soc/soc:firmware'
+HIGH = len(FAN_LEVELS) - 1
+
+class Clock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class FakeTree():
+    def __init__(self, root):
+        self.root = root
+        self.write('sys/class/thermal/thermal_zone0/type', 'cpu-thermal')
+        self.set_temperature(40)
+        self.busy = 0
+        self.idle = 0
+        self.set_busy(False)
+        self.write(f'{CPUFREQ}/cpuinfo_max_freq', 2400000)
+        self.set_freq(1500000, 1500000)
+
+    def write(self, path, value):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(f'{value}\n')
+
+    def set_temperature(self, celsius):
+        self.write('sys/class/thermal/thermal_zone0/temp', int(celsius * 1000))
+
+    def set_busy(self, busy):
+        # Add 1000 jiffies, mostly busy or mostly idle
+        self.busy += 950 if busy else 50
+        self.idle += 50 if busy else 950
+        # cpu user nice system idle iowait irq softirq steal
+        self.write('proc/stat', f'cpu {self.busy} 0 0 {self.idle} 0 0 0 0 0 0')
+
+    def set_nvme_temperature(self, celsius):
+        self.write('sys/class/hwmon/hwmon0/name', 'nvme')
+        self.write('sys/class/hwmon/hwmon0/temp1_input', int(celsius * 1000))
+
+    def set_freq(self, current, maximum):
+        self.write(f'{CPUFREQ}/scaling_cur_freq', current)
+        self.write(f'{CPUFREQ}/scaling_max_freq', maximum)
+
+@pytest.fixture
+def tree(tmp_path):
+    return FakeTree(str(tmp_path))
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+def kernel_driven(service):
+    '''Give the service a PWM fan left to the kernel, at OFF, and an SPC fan'''
+    service.pwm_fan = SimPWMFan(log=service.log, clock=service.clock)
+    service.pwm_fan.enable_control = False
+    service.spc_fan = SimSPCFan(log=service.log, clock=service.clock)
+    return service
+
+def run(service, clock):
+    clock.now += 1
+    service.run()
+    return service.level
+
+def test_reads_temperature_from_root(tree, clock):
+    tree.set_temperature(42.5)
+    service = FanService({}, root=tree.root, clock=clock)
+    assert service.get_cpu_temperature() == 42.5
+
+def test_runtime_cap_boosts_fan(tree, clock):
+    service = FanService({}, root=tree.root, clock=clock)
+    # Capped below cpuinfo_max_freq from the start, on purpose
+    assert run(service, clock) == 0
+    assert run(service, clock) == 0
+
+    tree.set_freq(1000000, 1000000)
+    assert run(service, clock) == HIGH
+
+    tree.set_freq(1500000, 1500000)
+    assert run(service, clock) < HIGH
+
+def test_busy_cpu_below_max_freq_boosts_fan(tree, clock):
+    service = FanService({}, root=tree.root, clock=clock)
+    tree.set_freq(600000, 1500000)
+    assert run(service, clock) == 0
+    tree.set_busy(True)
+    assert run(service, clock) == HIGH
+
+def test_no_boost_under_voltage(tree, clock):
+    # Firmware flags under voltage now, with the frequency capped because of it
+    tree.write(f'{FIRMWARE}/get_throttled', '0x5')
+    service = FanService({}, root=tree.root, clock=clock)
+    assert 'under_voltage' in service.check_throttle()
+    assert run(service, clock) == 0
+
+def test_kernel_driven_fan_follows_nvme(tree, clock):
+    tree.set_nvme_temperature(40)
+    service = kernel_driven(FanService({}, root=tree.root, clock=clock))
+    run(service, clock)
+    assert service.spc_fan.duty() == 0
+
+    tree.set_nvme_temperature(75)
+    run(service, clock)
+    assert service.spc_fan.duty() == 100
+
+def test_kernel_driven_fan_boosted_when_throttled(tree, clock):
+    service = kernel_driven(FanService({}, root=tree.root, clock=clock))
+    run(service, clock)
+    assert service.spc_fan.duty() == 0
+
+    tree.set_freq(1000000, 1000000)
+    run(service, clock)
+    assert service.spc_fan.duty() == 100
@@ -0,0 +1,30 @@
+'''
+MetricsSampler locking, a slow collector must not hold up other metrics.
+
+    python3 -m pytest test/test_metrics.py
+'''
+import threading
+import time
+
+from pm_auto.libs.metrics import MetricsSampler
+
+def test_slow_collector_does_not_block_others():
+    release = threading.Event()
+    started = threading.Event()
+    def slow_disks():
+        started.set()
+        release.wait(5)
+        return {}
+    sampler = MetricsSampler(collectors={
+        'disks': slow_disks,
+        'cpu_temperature': lambda: 50.0,
+    })
+    thread = threading.Thread(target=sampler.snapshot, args=('disks',))
+    thread.start()
+    assert started.wait(1)
+    start = time.monotonic()
+    assert sampler.get('cpu_temperature') == 50.0
+    assert time.monotonic() - start < 1
+    release.set()
+    thread.join()
+    assert sampler.get_stats()['collections'] == 2
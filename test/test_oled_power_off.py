@@ -0,0 +1,128 @@
+'''
+Power off screen of OLEDService must not spin while waiting for the button.
+
+Runs without hardware, the display is replaced by a fake SSD1306, and
+without the host system: sf_rpi_status is stubbed and the pages, which read
+metrics from sysfs, are replaced.
+
+    python3 -m pytest test/test_oled_power_off.py
+'''
+import sys
+import time
+import types
+import threading
+import importlib
+import pytest
+
+def stub_sf_rpi_status():
+    module = types.ModuleType('sf_rpi_status')
+    module.shutdown = lambda: None
+    module.get_disks_info = lambda *args, **kwargs: {}
+    module.get_ips = lambda *args, **kwargs: {}
+    return module
+
+PAGE_MODULES = {
+    'pm_auto.oled_page.performance': 'oled_page_performance',
+    'pm_auto.oled_page.ips': 'oled_page_ips',
+    'pm_auto.oled_page.disk': 'oled_page_disk',
+}
+
+def fake_page(oled):
+    oled.clear()
+    oled.draw_text('PAGE', 0, 0)
+    oled.display()
+
+class FakePanel:
+    def __init__(self):
+        self._buffer = bytearray(128*64//8)
+
+    def pack(self, image, buffer):
+        pass
+
+    def display(self):
+        pass
+
+class FakeSSD1306:
+    def __init__(self):
+        self.oled = FakePanel()
+        self.frames = 0
+        self.texts = []
+        self.is_off = threading.Event()
+
+    def is_ready(self):
+        return True
+
+    def set_rotation(self, rotation):
+        pass
+
+    def set_pipeline(self, pipeline):
+        pass
+
+    def get_stats(self):
+        return {}
+
+    def clear(self):
+        self.texts = []
+
+    def draw_text(self, text, *args, **kwargs):
+        self.texts.append(text)
+
+    def draw_icon(self, *args, **kwargs):
+        pass
+
+    def draw_bar_graph_horizontal(self, *args, **kwargs):
+        pass
+
+    def draw_pieslice_chart(self, *args, **kwargs):
+        pass
+
+    def display(self):
+        self.frames += 1
+
+    def off(self):
+        self.is_off.set()
+
+@pytest.fixture
+def oled_service(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'sf_rpi_status', stub_sf_rpi_status())
+    for name, page in PAGE_MODULES.items():
+        monkeypatch.setattr(importlib.import_module(name), page, fake_page)
+    from pm_auto.services import oled_service
+    monkeypatch.setattr(oled_service, 'SSD1306', FakeSSD1306)
+    return oled_service
+
+@pytest.fixture
+def service(oled_service):
+    service = oled_service.OLEDService({})
+    service.start()
+    yield service
+    service.stop()
+
+def test_power_off_screen_cpu_bounded(service, oled_service):
+    service.show_shutdown_screen(1)
+    time.sleep(0.2)
+    cpu_start = time.process_time()
+    time.sleep(1)
+    cpu_used = time.process_time() - cpu_start
+
+    assert service.current_page == oled_service.OLEDPage.POWER_OFF
+    assert 'POWER OFF' in service.oled.texts
+    # Rendered once, then idle
+    frames = service.oled.frames
+    time.sleep(0.2)
+    assert service.oled.frames == frames
+    assert cpu_used < 0.1
+
+def test_power_off_screen_released_by_button(service, oled_service):
+    service.show_shutdown_screen(1)
+    time.sleep(0.2)
+    assert not service.oled.is_off.is_set()
+    service.set_button('long_press_2s_released')
+    assert service.oled.is_off.wait(1)
+    assert service.current_page == oled_service.OLEDPage.OFF
+
+def test_power_off_screen_timeout(service, oled_service, monkeypatch):
+    monkeypatch.setattr(oled_service, 'POWER_OFF_TIMEOUT', 0.3)
+    service.show_shutdown_screen(1)
+    assert service.oled.is_off.wait(2)
+    assert service.current_page == oled_service.OLEDPage.OFF
@@ -0,0 +1,220 @@
+'''
+PironmanMCU against a register model of the MCU, a poll must be one block
+read and only set event registers may be written back.
+
+Service tests stub sf_rpi_status and gpiozero, so they run without them.
+
+    python3 -m pytest test/test_pironman_mcu.py
+'''
+import sys
+import time
+import types
+import pytest
+
+from pm_auto.libs import i2c
+from pm_auto.libs.i2c import I2C
+from pm_auto.libs.pironman_mcu import PironmanMCU, MCUSnapshot, RegisterAddress, \
+    ShutdownReason, PM_MCU_I2C_ADDR
+
+class FakeMCU():
+    '''
+    Stands in for SMBus, modelling the MCU registers. Block reads auto
+    increment the register address like the firmware does.
+    '''
+    def __init__(self, firmware_version=0b01001010, default_on=1):
+        self.registers = bytearray(len(RegisterAddress))
+        self.registers[RegisterAddress.FIRMWARE_VERSION] = firmware_version
+        self.registers[RegisterAddress.DEFAULT_ON] = default_on
+        # (operation, register)
+        self.transfers = []
+
+    def _check(self, address):
+        if address != PM_MCU_I2C_ADDR:
+            raise OSError(121, 'Remote I/O error')
+
+    def press(self, button):
+        self.registers[RegisterAddress.PWR_BTN] = button
+
+    def request_shutdown(self, reason=ShutdownReason.BUTTON):
+        self.registers[RegisterAddress.SHUTDOWN_REQ] = reason
+
+    def read_byte(self, address, force=False):
+        self._check(address)
+        return 0
+
+    def write_byte(self, address, value, force=False):
+        self._check(address)
+
+    def read_i2c_block_data(self, address, register, length):
+        self._check(address)
+        self.transfers.append(('read', register))
+        return list(self.registers[register:register + length])
+
+    def write_byte_data(self, address, register, value):
+        self._check(address)
+        self.transfers.append(('write', register))
+        self.registers[register] = value
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def fake_mcu(monkeypatch):
+    fake = FakeMCU()
+    monkeypatch.setattr(i2c, 'SMBus', lambda bus: fake)
+    monkeypatch.setattr(i2c, '_buses', {})
+    monkeypatch.setattr(I2C, 'enabled', staticmethod(lambda bus=1: True))
+    I2C.invalidate_scan_cache()
+    yield fake
+    I2C.invalidate_scan_cache()
+
+def test_idle_snapshot_is_one_read(fake_mcu):
+    mcu = PironmanMCU()
+    snapshot = mcu.get_snapshot()
+    assert isinstance(snapshot, MCUSnapshot)
+    assert snapshot.firmware_version == (1, 1, 2)
+    assert snapshot.default_on is True
+    assert snapshot.button == 0
+    assert snapshot.shutdown_request == ShutdownReason.NONE
+    assert fake_mcu.transfers == [('read', RegisterAddress.FIRMWARE_VERSION)]
+    assert not hasattr(snapshot, '__dict__')
+
+def test_snapshot_clears_only_set_registers(fake_mcu):
+    mcu = PironmanMCU()
+    fake_mcu.press(1)
+    snapshot = mcu.get_snapshot()
+    assert snapshot.button_name == 'single_click'
+    assert snapshot.shutdown_request == ShutdownReason.NONE
+    assert fake_mcu.transfers == [
+        ('read', RegisterAddress.FIRMWARE_VERSION),
+        ('write', RegisterAddress.PWR_BTN),
+    ]
+    assert fake_mcu.registers[RegisterAddress.PWR_BTN] == 0
+
+    fake_mcu.transfers.clear()
+    fake_mcu.request_shutdown()
+    snapshot = mcu.get_snapshot()
+    assert snapshot.button == 0
+    assert snapshot.shutdown_request == ShutdownReason.BUTTON
+    assert fake_mcu.transfers == [
+        ('read', RegisterAddress.FIRMWARE_VERSION),
+        ('write', RegisterAddress.SHUTDOWN_REQ),
+    ]
+    assert mcu.get_snapshot().shutdown_request == ShutdownReason.NONE
+
+class FakeInputDevice():
+    '''Stands in for a gpiozero DigitalInputDevice'''
+    def __init__(self, pin, pull_up=True):
+        self.pin = pin
+        self.is_active = False
+        self.when_activated = None
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def mcu_service(fake_mcu, monkeypatch):
+    '''The pironman_mcu_service module with sf_rpi_status and gpiozero stubbed'''
+    sf_rpi_status = types.ModuleType('sf_rpi_status')
+    sf_rpi_status.shutdown = lambda: None
+    gpiozero = types.ModuleType('gpiozero')
+    gpiozero.DigitalInputDevice = FakeInputDevice
+    monkeypatch.setitem(sys.modules, 'sf_rpi_status', sf_rpi_status)
+    monkeypatch.setitem(sys.modules, 'gpiozero', gpiozero)
+    from pm_auto.services import pironman_mcu_service
+    return pironman_mcu_service
+
+def test_service_loop_consumes_snapshot(mcu_service, fake_mcu, monkeypatch):
+    service = mcu_service.PironmanMCUService({})
+    buttons = []
+    service.set_on_wakeup(buttons.append)
+    fake_mcu.press(2)
+    def next_interval(active, now):
+        service.running = False
+        return 0
+    monkeypatch.setattr(service, 'next_interval', next_interval)
+    service.running = True
+    service.loop()
+    assert buttons == ['double_click']
+    assert fake_mcu.transfers == [
+        ('read', RegisterAddress.FIRMWARE_VERSION),
+        ('write', RegisterAddress.PWR_BTN),
+    ]
+
+def test_idle_polling_backs_off(mcu_service):
+    INTERVAL = mcu_service.INTERVAL
+    ACTIVE_TIME = mcu_service.ACTIVE_TIME
+
+    service = mcu_service.PironmanMCUService({})
+    now = 0.0
+    while now < ACTIVE_TIME:
+        now += service.next_interval(False, now)
+    # Steady state, fixed 100 ms polling would be 600 polls a minute
+    polls = 0
+    end = now + 60
+    while now < end:
+        now += service.next_interval(False, now)
+        polls += 1
+    assert polls <= 60 / INTERVAL / 10
+    assert service.next_interval(False, now) == mcu_service.IDLE_INTERVAL
+
+    # An event brings fast polling back for ACTIVE_TIME
+    assert service.next_interval(True, now) == INTERVAL
+    assert service.next_interval(False, now + ACTIVE_TIME / 2) == INTERVAL
+    assert service.next_interval(False, now + ACTIVE_TIME + 1) > INTERVAL
+
+def test_interrupt_wakes_loop(mcu_service, fake_mcu):
+    service = mcu_service.PironmanMCUService({'pironman_mcu_interrupt_pin': 4})
+    assert service.interrupt.pin == 4
+    assert service.next_interval(False, 0) == mcu_service.INTERRUPT_INTERVAL
+
+    buttons = []
+    service.set_on_wakeup(buttons.append)
+    service.start()
+    fake_mcu.press(1)
+    service.interrupt.when_activated()
+    for _ in range(100):
+        if buttons:
+            break
+        time.sleep(0.01)
+    service.stop()
+    assert buttons == ['single_click']
+    # Woken by the startup check and the edge, not by the safety poll
+    assert service.polls <= 3
+
+def test_interrupt_closed_by_update_config(mcu_service):
+    service = mcu_service.PironmanMCUService({'pironman_mcu_interrupt_pin': 4})
+    interrupt = service.interrupt
+    # Like update_config() on another thread closing the device mid poll
+    class Closed():
+        @property
+        def is_active(self):
+            raise RuntimeError('device closed')
+    service.interrupt = Closed()
+    assert service.next_interval(False, 0) == mcu_service.INTERVAL
+    service.interrupt = interrupt
+    service.update_config({'pironman_mcu_interrupt_pin': None})
+    assert interrupt.closed
+    assert service.interrupt is None
+
+def test_loop_survives_errors(mcu_service, fake_mcu, monkeypatch):
+    service = mcu_service.PironmanMCUService({'pironman_mcu_idle_interval': 0.1})
+    buttons = []
+    service.set_on_wakeup(buttons.append)
+    polls = []
+    real_poll = service.poll
+    def poll():
+        polls.append(1)
+        if len(polls) == 1:
+            raise OSError(121, 'Remote I/O error')
+        return real_poll()
+    monkeypatch.setattr(service, 'poll', poll)
+    fake_mcu.press(1)
+    service.start()
+    for _ in range(100):
+        if buttons:
+            break
+        time.sleep(0.01)
+    service.stop()
+    assert buttons == ['single_click']
@@ -0,0 +1,74 @@
+'''
+SSD1306 shadow buffer against a fake I2C bus, an invalidation arriving while
+a frame is on the bus must not be lost.
+
+    python3 -m pytest test/test_ssd1306.py
+'''
+import pytest
+
+from pm_auto.libs import i2c
+from pm_auto.libs.i2c import I2C
+from pm_auto.libs.ssd1306 import SSD1306_128_64, SSD1306_I2C_ADDRESS_1
+
+class FakeBus():
+    '''Stands in for SMBus, counting the display data bytes sent'''
+    def __init__(self):
+        self.data_bytes = 0
+        # Called in the middle of the next transfer
+        self.during_transfer = None
+
+    def read_byte(self, address, force=False):
+        if address != SSD1306_I2C_ADDRESS_1:
+            raise OSError(121, 'Remote I/O error')
+        return 0
+
+    def write_byte(self, address, value, force=False):
+        self.read_byte(address)
+
+    def write_byte_data(self, address, register, value):
+        pass
+
+    def write_i2c_block_data(self, address, register, data):
+        pass
+
+    def i2c_rdwr(self, *messages):
+        # Data messages start with the data control byte 0x40
+        for message in messages:
+            data = bytes(message)
+            if data[0] == 0x40:
+                self.data_bytes += len(data) - 1
+        if self.during_transfer is not None:
+            callback, self.during_transfer = self.during_transfer, None
+            callback()
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def bus(monkeypatch):
+    fake = FakeBus()
+    monkeypatch.setattr(i2c, 'SMBus', lambda bus: fake)
+    monkeypatch.setattr(i2c, '_buses', {})
+    monkeypatch.setattr(I2C, 'enabled', staticmethod(lambda bus=1: True))
+    I2C.invalidate_scan_cache()
+    yield fake
+    I2C.invalidate_scan_cache()
+
+def test_unchanged_frame_sends_nothing(bus):
+    panel = SSD1306_128_64()
+    panel.display()
+    assert bus.data_bytes == 128 * 64 // 8
+    bus.data_bytes = 0
+    panel.display()
+    assert bus.data_bytes == 0
+
+def test_invalidation_during_transfer_is_kept(bus):
+    panel = SSD1306_128_64()
+    panel.display()
+    panel._buffer[0] = 0xFF
+    # Like set_rotation() on another thread while the frame is on the bus
+    bus.during_transfer = panel.force_full_refresh
+    panel.display()
+    bus.data_bytes = 0
+    panel.display()
+    assert bus.data_bytes == 128 * 64 // 8